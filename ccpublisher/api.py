@@ -14,10 +14,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
 import enum
 import logging
 import json
+import time
 from pathlib import Path
 import dataclasses
 
@@ -29,10 +31,16 @@ import marshmallow.validate
 import aiohttp_jinja2
 
 
-from ccpublisher import __version__
+from ccpublisher import metrics, __version__
 
 logger = logging.getLogger(__name__)
 
+HTTP_REQUEST_DURATION = metrics.Histogram(
+    "ccpublisher_http_request_duration_seconds",
+    "Duration of the HTTP requests, by method, route and status",
+    labels=("method", "route", "status"),
+)
+
 
 class TaskIdSchema(marshmallow.Schema):
     task_id = marshmallow.fields.Integer(
@@ -46,6 +54,60 @@ class ProfileIdSchema(marshmallow.Schema):
     )
 
 
+class TaskCreationSchema(ProfileIdSchema):
+    priority = marshmallow.fields.Integer(
+        description="Priority of the task, higher values are served first",
+        load_default=0,
+    )
+    deadline = marshmallow.fields.DateTime(
+        description="Time by which the publishing should be completed (ISO 8601)"
+    )
+    force = marshmallow.fields.Boolean(
+        description="Publish even if the CC resource is already up to date",
+        load_default=False,
+    )
+
+
+class TaskPositionSchema(marshmallow.Schema):
+    position = marshmallow.fields.Integer(
+        description="New zero-based position of the task in the listed queue",
+        required=True,
+    )
+
+
+class WorkerIdSchema(marshmallow.Schema):
+    worker_id = marshmallow.fields.Integer(
+        description="Numeric ID of the worker (all workers if omitted)"
+    )
+
+
+class OutputLinesSchema(marshmallow.Schema):
+    lines = marshmallow.fields.Integer(
+        description="Maximum number of lines to return for each stream",
+        validate=marshmallow.validate.Range(min=1),
+    )
+
+
+class HistoryLimitSchema(marshmallow.Schema):
+    limit = marshmallow.fields.Integer(
+        description="Maximum number of records to return, most recent last",
+        validate=marshmallow.validate.Range(min=1),
+    )
+
+
+class LogLinesCursorSchema(marshmallow.Schema):
+    since = marshmallow.fields.Integer(
+        description="Sequence number of the last line already received, "
+        "only the following lines are returned",
+        load_default=0,
+        validate=marshmallow.validate.Range(min=0),
+    )
+    file = marshmallow.fields.String(
+        description="Path of one of the observed files, all of them merged "
+        "if omitted"
+    )
+
+
 class RefreshKindSchema(marshmallow.Schema):
     refresh = marshmallow.fields.String(
         validate=marshmallow.validate.OneOf(["known", "all"])
@@ -67,19 +129,37 @@ class CustomEncoder(json.JSONEncoder):
 
 
 class API:
+    # Seconds between keepalive comments on an idle event stream
+    EVENTS_KEEPALIVE = 15
+    # Minimum seconds between two pushes, coalescing bursts of changes
+    EVENTS_MIN_INTERVAL = 0.25
+    # Sections of the status left out of the events, the log being followed
+    # incrementally through the loglines event stream instead
+    EVENTS_EXCLUDED_SECTIONS = {"loglines"}
+    # Event streams last as long as their clients, they're not timed
+    UNTIMED_ROUTES = {"/api/v1/events", "/api/v1/loglines/events"}
+
     def __init__(
         self,
         publisher,
         fileobserver,
         profiles_manager,
+        notifier,
         extra_context,
         listen_address,
         port,
+        profiles_ttl=60,
     ):
         self._publisher = publisher
         self._fileobserver = fileobserver
         self._profiles_manager = profiles_manager
+        self._notifier = notifier
+        # (version, sections) of the last encoded status
+        self._encoded_status = None
+        # Keeps ETags unique across restarts, when versions start over
+        self._etag_prefix = f"{int(time.time()):x}"
         self._extra_context = extra_context
+        self._profiles_ttl = profiles_ttl
         self._listen_address = listen_address
         self._port = port
         self._site = None
@@ -97,19 +177,30 @@ class API:
 
         # Service
         r.add_get("/api/v1/status", self._get_full_status, allow_head=False)
+        r.add_get("/api/v1/events", self._get_events, allow_head=False)
+        r.add_get("/metrics", self._get_metrics, allow_head=False)
 
         # Tasks
         r.add_get("/api/v1/tasks", self._get_tasks, allow_head=False)
         r.add_post("/api/v1/tasks", self._create_task)
         r.add_delete("/api/v1/tasks", self._remove_all_tasks)
         r.add_delete("/api/v1/tasks/{task_id}", self._remove_task)
+        r.add_patch("/api/v1/tasks/{task_id}", self._move_task)
+        r.add_get(
+            "/api/v1/tasks/{task_id}/output", self._get_task_output, allow_head=False
+        )
         r.add_delete("/api/v1/current_task", self._terminate_current_task)
+        r.add_get("/api/v1/history", self._get_history, allow_head=False)
 
         # Profiles
         r.add_get("/api/v1/profiles", self._get_profiles, allow_head=False)
 
         # Log
         r.add_get("/api/v1/loglines", self._get_loglines, allow_head=False)
+        r.add_get(
+            "/api/v1/loglines/events", self._get_loglines_events, allow_head=False
+        )
+        r.add_get("/api/v1/logfiles", self._get_logfiles, allow_head=False)
 
         aiohttp_apispec.setup_aiohttp_apispec(
             app=self._app,
@@ -118,6 +209,7 @@ class API:
             version=__version__.__version__,
             error_callback=self._on_validation_error,
         )
+        self._app.middlewares.append(self._metrics_recorder)
         self._app.middlewares.append(aiohttp_apispec.validation_middleware)
         self._app.middlewares.append(self._error_wrapper)
 
@@ -147,6 +239,7 @@ class API:
             web.HTTPUnauthorized,
             web.HTTPNoContent,
             web.HTTPCreated,
+            web.HTTPNotModified,
         ):
             raise
         except Exception as e:
@@ -156,6 +249,29 @@ class API:
         else:
             return resp
 
+    @web.middleware
+    async def _metrics_recorder(self, request, handler):
+        resource = request.match_info.route.resource
+        if resource is not None and resource.canonical in self.UNTIMED_ROUTES:
+            return await handler(request)
+
+        start = time.perf_counter()
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=request.method,
+                route=resource.canonical if resource else "unmatched",
+                status=status,
+            )
+
     def _redirect(self, request):
         raise web.HTTPFound("/ui")
 
@@ -166,15 +282,19 @@ class API:
         return {
             "publisher": self._publisher.get_current_status(),
             "loglines": self._fileobserver.lines,
+            "profiles_version": self._profiles_manager.version,
         }
 
     @aiohttp_jinja2.template("index.html")
     async def _index(self, request):
-        await self._profiles_manager.refresh_known_profiles()
+        # Rendered right away from the known profiles, refreshing them in
+        # background for the next loads when they're older than the TTL
+        self._profiles_manager.revalidate(self._profiles_ttl)
 
         return {
             "status": await self._get_status(),
             "profiles": self._profiles_manager.profiles,
+            "log_backlog": self._fileobserver.backlog,
             "extra_context": self._extra_context,
             "version": __version__.__version__,
         }
@@ -182,14 +302,145 @@ class API:
     @aiohttp_apispec.docs(
         tags=["service"],
         summary="Get the current status of the service",
-        description="",
+        description="The response carries an ETag, requests bearing it in "
+        "If-None-Match get a 304 until the status changes. Running tasks carry "
+        "their start_time, to be compared with the server time of the response "
+        "(their elapsed time and stats are reported by the task output endpoint)",
         responses={
             200: {"description": "Status report object returned"},
+            304: {"description": "Status unchanged"},
             500: {"description": "Server side error"},
         },
     )
     async def _get_full_status(self, request):
-        return web.json_response(await self._get_status(), dumps=CustomEncoder().encode)
+        version, sections = await self._get_encoded_status()
+        # Weak, since the server time differs across responses
+        etag = f'W/"{self._etag_prefix}-{version}"'
+
+        if etag in request.headers.get("If-None-Match", ""):
+            raise web.HTTPNotModified(headers={"ETag": etag})
+
+        return web.Response(
+            body=self._join_sections(self._add_server_time(sections)).encode(),
+            content_type="application/json",
+            headers={"ETag": etag},
+        )
+
+    @aiohttp_apispec.docs(
+        tags=["service"],
+        summary="Get the metrics of the service",
+        description="Metrics are exposed in the Prometheus text format",
+        responses={
+            200: {"description": "Metrics returned"},
+            500: {"description": "Server side error"},
+        },
+    )
+    async def _get_metrics(self, request):
+        return web.Response(
+            text=metrics.REGISTRY.expose(),
+            headers={"Content-Type": metrics.Registry.CONTENT_TYPE},
+        )
+
+    @aiohttp_apispec.docs(
+        tags=["service"],
+        summary="Stream status changes as server-sent events",
+        description="The first event carries the full status, the following ones "
+        "only the entries of each section that changed since the previous event. "
+        "Every event carries the server time at which it was sent. The log lines "
+        "are left out, being streamed by the loglines events endpoint",
+        responses={
+            200: {"description": "Event stream opened"},
+            500: {"description": "Server side error"},
+        },
+    )
+    async def _get_events(self, request):
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+            }
+        )
+        await response.prepare(request)
+
+        sent = {}
+        version = None
+
+        try:
+            while True:
+                try:
+                    version = await self._notifier.wait(
+                        version, timeout=self.EVENTS_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+                    continue
+
+                version, sections = await self._get_encoded_status()
+                sections = {
+                    section: encoded
+                    for section, encoded in sections.items()
+                    if section not in self.EVENTS_EXCLUDED_SECTIONS
+                }
+                diff = self._get_sections_diff(sections, sent)
+                if diff:
+                    data = self._join_sections(self._add_server_time(diff))
+                    await response.write(
+                        f"id: {version}\nevent: status\ndata: {data}\n\n".encode()
+                    )
+                    sent = sections
+
+                await asyncio.sleep(self.EVENTS_MIN_INTERVAL)
+        except ConnectionResetError:
+            logger.debug("Event stream client disconnected")
+
+        return response
+
+    async def _get_encoded_status(self):
+        # The status is encoded once per version, sections holding a dict are
+        # kept encoded entry by entry so that they can be diffed cheaply. It
+        # mustn't hold values changing between versions, such as the elapsed
+        # time of running tasks, which would be reported stale.
+        version = self._notifier.version
+        if self._encoded_status is None or self._encoded_status[0] != version:
+            encoder = CustomEncoder()
+            sections = {}
+            for section, value in (await self._get_status()).items():
+                if isinstance(value, dict):
+                    sections[section] = {k: encoder.encode(v) for k, v in value.items()}
+                else:
+                    sections[section] = encoder.encode(value)
+
+            self._encoded_status = (version, sections)
+
+        return self._encoded_status
+
+    def _add_server_time(self, sections):
+        # Lets clients tell how long running tasks have been running, whatever
+        # the version of the status they get
+        return {**sections, "time": json.dumps(time.time())}
+
+    def _get_sections_diff(self, sections, sent):
+        diff = {}
+        for section, encoded in sections.items():
+            previous = sent.get(section)
+            if isinstance(encoded, dict):
+                previous = previous or {}
+                changed = {k: v for k, v in encoded.items() if previous.get(k) != v}
+                if changed:
+                    diff[section] = changed
+            elif encoded != previous:
+                diff[section] = encoded
+
+        return diff
+
+    def _join_sections(self, sections):
+        entries = []
+        for section, encoded in sections.items():
+            if isinstance(encoded, dict):
+                encoded = self._join_sections(encoded)
+            entries.append(f"{json.dumps(section)}: {encoded}")
+
+        return f"{{{', '.join(entries)}}}"
 
     @aiohttp_apispec.docs(
         tags=["tasks"],
@@ -210,24 +461,34 @@ class API:
         summary="Enqueue a publishing task",
         description="",
         responses={
+            200: {"description": "Request merged into an enqueued or running task"},
             201: {"description": "Task created"},
             404: {"description": "Resource not found"},
             500: {"description": "Server side error"},
         },
     )
-    @aiohttp_apispec.request_schema(ProfileIdSchema)
+    @aiohttp_apispec.request_schema(TaskCreationSchema)
     async def _create_task(self, request):
         profile_id = request["data"]["profile_id"]
         profile = self._profiles_manager.get_profile(profile_id)
+        if profile is None:
+            raise web.HTTPNotFound()
 
-        task_id = self._publisher.publish(profile)
+        deadline = request["data"].get("deadline", None)
+        task_id, created = self._publisher.publish(
+            profile,
+            priority=request["data"]["priority"],
+            deadline=deadline.timestamp() if deadline else None,
+            force=request["data"]["force"],
+        )
 
         return web.json_response(
             {
                 "profile_id": profile_id,
                 "task_id": task_id,
+                "created": created,
             },
-            status=web.HTTPCreated.status_code,
+            status=web.HTTPCreated.status_code if created else web.HTTPOk.status_code,
             dumps=CustomEncoder().encode,
         )
 
@@ -248,6 +509,60 @@ class API:
         else:
             raise web.HTTPNotFound()
 
+    @aiohttp_apispec.docs(
+        tags=["tasks"],
+        summary="Move an enqueued task to another position of the queue",
+        description="Tasks are listed pinned first, ordered by their scheduling "
+        "rank (deadline, priority and estimated duration), pinned last. A task "
+        "moved among the pinned ones is pinned there, one moved amid the ranked "
+        "ones is unpinned",
+        responses={
+            204: {"description": "Successfully moved enqueued task"},
+            404: {"description": "Task not found"},
+            500: {"description": "Server side error"},
+        },
+    )
+    @aiohttp_apispec.match_info_schema(TaskIdSchema)
+    @aiohttp_apispec.request_schema(TaskPositionSchema)
+    async def _move_task(self, request):
+        if self._publisher.move_task(
+            request["match_info"]["task_id"], request["data"]["position"]
+        ):
+            raise web.HTTPNoContent()
+        else:
+            raise web.HTTPNotFound()
+
+    @aiohttp_apispec.docs(
+        tags=["tasks"],
+        summary="Get the tail of the output of a running or a recently completed task",
+        description="The output of the last task completed by each worker is kept",
+        responses={
+            200: {"description": "Output lines returned"},
+            404: {"description": "Task not found"},
+            500: {"description": "Server side error"},
+        },
+    )
+    @aiohttp_apispec.match_info_schema(TaskIdSchema)
+    @aiohttp_apispec.querystring_schema(OutputLinesSchema)
+    async def _get_task_output(self, request):
+        task = self._publisher.get_task(request["match_info"]["task_id"])
+        if task is None:
+            raise web.HTTPNotFound()
+
+        count = request["querystring"].get("lines", None)
+
+        return web.json_response(
+            {
+                "task_id": task.task_id,
+                "running": task.end_time == 0,
+                "output_file": task.output_file,
+                "elapsed": task.elapsed,
+                "stats": dataclasses.asdict(task.stats) if task.stats else None,
+                "stdout": task.stdout.tail(count) if count else task.stdout.lines,
+                "stderr": task.stderr.tail(count) if count else task.stderr.lines,
+            }
+        )
+
     @aiohttp_apispec.docs(
         tags=["tasks"],
         summary="Remove all enqueued task",
@@ -271,12 +586,29 @@ class API:
             500: {"description": "Server side error"},
         },
     )
-    def _terminate_current_task(self, request):
-        if self._publisher.terminate_running_task():
+    @aiohttp_apispec.querystring_schema(WorkerIdSchema)
+    async def _terminate_current_task(self, request):
+        worker_id = request["querystring"].get("worker_id", None)
+        if self._publisher.terminate_running_task(worker_id):
             raise web.HTTPNoContent()
         else:
             raise web.HTTPNotFound()
 
+    @aiohttp_apispec.docs(
+        tags=["tasks"],
+        summary="Get the records of the completed tasks",
+        description="",
+        responses={
+            200: {"description": "List of task records returned"},
+            500: {"description": "Server side error"},
+        },
+    )
+    @aiohttp_apispec.querystring_schema(HistoryLimitSchema)
+    async def _get_history(self, request):
+        return web.json_response(
+            self._publisher.get_history(request["querystring"].get("limit", None))
+        )
+
     @aiohttp_apispec.docs(
         tags=["profiles"],
         summary="Get a list of profiles",
@@ -301,14 +633,94 @@ class API:
     @aiohttp_apispec.docs(
         tags=["loglines"],
         summary="Get a backlog of lines from the log",
-        description="",
+        description="The returned cursor is the sequence number of the last "
+        "line, to be passed as since to get only newer lines. The truncated flag "
+        "is set when some lines following since are no longer available",
         responses={
             200: {"description": "Log entries returned"},
+            404: {"description": "File not observed"},
             500: {"description": "Server side error"},
         },
     )
+    @aiohttp_apispec.querystring_schema(LogLinesCursorSchema)
     async def _get_loglines(self, request):
-        return web.json_response(self._fileobserver.lines)
+        buffer = self._get_log_buffer(request)
+        lines, truncated = buffer.since(request["querystring"]["since"])
+
+        return web.json_response(
+            {"lines": lines, "cursor": buffer.last_seq, "truncated": truncated}
+        )
+
+    @aiohttp_apispec.docs(
+        tags=["loglines"],
+        summary="Follow the log as server-sent events",
+        description="Each event carries the lines added after the previous one, "
+        "starting after since (or the Last-Event-ID of a reconnecting client). "
+        "Clients too slow to keep up get the truncated flag set, since lines "
+        "are only retained in the backlog",
+        responses={
+            200: {"description": "Event stream opened"},
+            404: {"description": "File not observed"},
+            500: {"description": "Server side error"},
+        },
+    )
+    @aiohttp_apispec.querystring_schema(LogLinesCursorSchema)
+    async def _get_loglines_events(self, request):
+        buffer = self._get_log_buffer(request)
+        notifier = self._fileobserver.lines_notifier
+        cursor = request["querystring"]["since"]
+        if request.headers.get("Last-Event-ID", "").isdigit():
+            cursor = int(request.headers["Last-Event-ID"])
+
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+            }
+        )
+        await response.prepare(request)
+
+        try:
+            while True:
+                # Lines are pulled from the backlog rather than queued for each
+                # client: a slow one is held back by write() and then skips
+                # the lines evicted in the meantime, using no extra memory
+                version = notifier.version
+                lines, truncated = buffer.since(cursor)
+                if lines or truncated:
+                    cursor = buffer.last_seq
+                    data = json.dumps({"lines": lines, "truncated": truncated})
+                    await response.write(
+                        f"id: {cursor}\nevent: lines\ndata: {data}\n\n".encode()
+                    )
+
+                try:
+                    await notifier.wait(version, timeout=self.EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            logger.debug("Log event stream client disconnected")
+
+        return response
+
+    @aiohttp_apispec.docs(
+        tags=["loglines"],
+        summary="Get the list of the observed log files",
+        description="",
+        responses={
+            200: {"description": "List of file paths returned"},
+            500: {"description": "Server side error"},
+        },
+    )
+    async def _get_logfiles(self, request):
+        return web.json_response(self._fileobserver.files)
+
+    def _get_log_buffer(self, request):
+        buffer = self._fileobserver.get_buffer(request["querystring"].get("file"))
+        if buffer is None:
+            raise web.HTTPNotFound()
+
+        return buffer
 
     def _on_validation_error(
         self, error, req, schema, error_status_code, error_headers
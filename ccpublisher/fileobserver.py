@@ -15,32 +15,71 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import glob
+import itertools
 import logging
 import enum
 import os
+import time
+from dataclasses import dataclass
 from pathlib import Path
 
 import aiofiles
 import aionotify
 
+from ccpublisher import linebuffer
+from ccpublisher.notifier import ChangeNotifier
+
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class ObservedFile:
+    path: Path
+    buffer: linebuffer.LineBuffer
+    state: enum.Enum
+    handle: object = None
+    # Monotonic time of the last lines read
+    last_active: float = 0
+
+
 class FileObserver:
-    SKIP_FILESIZE_THRESHOLD = 1e06
-    SKIP_PERCENT = 0.8
+    """Tails the files matching a set of paths or glob patterns
+
+    A single inotify watcher covers the directories of all the patterns
+    (directory patterns are expanded at startup). Each file has its own
+    backlog, and its lines are also added to a merged backlog in the order
+    in which they're read. When several files can match, merged lines are
+    prefixed with the path of their file, relative to the directory common
+    to all the patterns. At most max_files files are observed: beyond that,
+    the one idle the longest is closed (as files like the logs of completed
+    tasks would otherwise pile up), until it's written again.
+    """
+
+    # Size of the blocks read backwards from the end when opening a file
+    TAIL_BLOCK_SIZE = 65536
 
     class State(enum.Enum):
         INIT = enum.auto()
         CLOSED = enum.auto()
         OPENED = enum.auto()
 
-    def __init__(self, file_path, backlog):
-        self._file_path = Path(file_path)
+    def __init__(self, file_path, backlog, max_files=20, notifier=None):
+        patterns = [file_path] if isinstance(file_path, str) else file_path
+        self._patterns = [str(Path(pattern)) for pattern in patterns]
         self._backlog = backlog
-        self._state = self.State.INIT
-        self._lines = []
+        self._max_files = max_files
+        self._tag_lines = len(self._patterns) > 1 or any(
+            map(glob.has_magic, self._patterns)
+        )
+        self._tag_root = self._get_tag_root()
+        # Path -> ObservedFile
+        self._files = {}
+        self._buffer = linebuffer.LineBuffer(backlog)
+        self._notifier = notifier or ChangeNotifier()
+        # Notified only when lines are added, for who follows the log
+        self._lines_notifier = ChangeNotifier()
 
         self._watcher = aionotify.Watcher()
         flags = (
@@ -49,12 +88,33 @@ class FileObserver:
             | aionotify.Flags.DELETE
             | aionotify.Flags.MOVED_FROM
         )
-        self._watcher.watch(path=str(self._file_path.parent), flags=flags)
-        logger.info(f"inotify set up to watch path: {self._file_path.parent}")
+        for directory in self._get_directories():
+            self._watcher.watch(path=str(directory), flags=flags)
+            logger.info(f"inotify set up to watch path: {directory}")
 
     @property
     def lines(self):
-        return self._lines
+        return self._buffer.lines
+
+    @property
+    def backlog(self):
+        return self._backlog
+
+    @property
+    def files(self):
+        return [str(path) for path in self._files]
+
+    @property
+    def lines_notifier(self):
+        return self._lines_notifier
+
+    def get_buffer(self, file_path=None):
+        """Backlog of a single file, or the merged one if file_path is None"""
+        if file_path is None:
+            return self._buffer
+
+        observed = self._files.get(Path(file_path))
+        return observed.buffer if observed else None
 
     def start(self):
         return asyncio.create_task(self._observer_task(), name="File observer task")
@@ -62,14 +122,14 @@ class FileObserver:
     async def _observer_task(self):
         await self._watcher.setup(asyncio.get_running_loop())
 
-        if self._file_path.exists():
-            logfile = await self._open_file()
-            self._state = self.State.OPENED
-        else:
+        paths = self._get_existing_paths()
+        if not paths:
             logger.warning(
-                f"File {self._file_path} does not exist, " f"delaying opening"
+                f"No file matching {', '.join(self._patterns)} exists, "
+                f"delaying opening"
             )
-            logfile = None
+        for path in paths[-self._max_files :]:
+            await self._open_file(await self._add_observed_file(path))
 
         while True:
             event = await self._watcher.get_event()
@@ -77,59 +137,152 @@ class FileObserver:
                 f"inotify event: {event} " f"flags={aionotify.Flags.parse(event.flags)}"
             )
 
-            if event.name == self._file_path.name:
-                if (
-                    aionotify.Flags.MODIFY & event.flags
-                    and self._state == self.State.OPENED
-                ):
-                    while True:
-                        line = await logfile.readline()
-                        if not line:
-                            break
-
-                        self._add_line(line.strip())
-                elif (
-                    aionotify.Flags.DELETE & event.flags
-                    or aionotify.Flags.MOVED_FROM & event.flags
-                ) and self._state == self.State.OPENED:
-                    logger.info("Closing file since it has been " "deleted or moved")
-                    await logfile.close()
-                    logfile = None
-                    self._state = self.State.CLOSED
-                elif aionotify.Flags.CREATE & event.flags and self._state in (
-                    self.State.CLOSED,
-                    self.State.INIT,
-                ):
-                    if self._state == self.State.CLOSED:
-                        logger.info("Reopening file")
-                    logfile = await self._open_file()
-                    self._state = self.State.OPENED
-
-    def _add_line(self, line):
-        self._lines.append(line)
-        self._lines = self._lines[-self._backlog :]
-
-    async def _open_file(self):
+            path = Path(event.alias) / event.name
+            if not self._matches(path):
+                continue
+
+            observed = self._files.get(path)
+            if observed is None:
+                # Files not observed (anymore) are picked up again when written
+                if (aionotify.Flags.CREATE | aionotify.Flags.MODIFY) & event.flags:
+                    await self._open_file(await self._add_observed_file(path))
+                continue
+
+            if (
+                aionotify.Flags.MODIFY & event.flags
+                and observed.state == self.State.OPENED
+            ):
+                await self._read_lines(observed)
+            elif (
+                aionotify.Flags.DELETE & event.flags
+                or aionotify.Flags.MOVED_FROM & event.flags
+            ) and observed.state == self.State.OPENED:
+                logger.info(f"Closing {path} since it has been deleted or moved")
+                await observed.handle.close()
+                observed.handle = None
+                observed.state = self.State.CLOSED
+            elif aionotify.Flags.CREATE & event.flags and observed.state in (
+                self.State.CLOSED,
+                self.State.INIT,
+            ):
+                if observed.state == self.State.CLOSED:
+                    logger.info(f"Reopening {path}")
+                await self._open_file(observed)
+
+    def _get_directories(self):
+        directories = set()
+        for pattern in self._patterns:
+            parent = Path(pattern).parent
+            if glob.has_magic(str(parent)):
+                directories.update(map(Path, glob.glob(f"{parent}/")))
+            else:
+                directories.add(parent)
+
+        return sorted(directories)
+
+    def _get_tag_root(self):
+        roots = [
+            Path(*itertools.takewhile(lambda part: not glob.has_magic(part), parts))
+            for parts in (Path(pattern).parent.parts for pattern in self._patterns)
+        ]
+        try:
+            return Path(os.path.commonpath(roots))
+        except ValueError:
+            # Absolute and relative patterns are mixed
+            return Path("/")
+
+    def _get_existing_paths(self):
+        paths = {
+            Path(path)
+            for pattern in self._patterns
+            for path in glob.glob(pattern)
+            if os.path.isfile(path)
+        }
+
+        # Older files first, so that the merged backlog ends with the latest
+        return sorted(paths, key=lambda path: path.stat().st_mtime)
+
+    def _matches(self, path):
+        return any(path.match(pattern) for pattern in self._patterns)
+
+    async def _add_observed_file(self, path):
+        if len(self._files) >= self._max_files:
+            idlest = min(
+                self._files.values(), key=lambda observed: observed.last_active
+            )
+            logger.info(f"No longer observing {idlest.path}, idle the longest")
+            if idlest.handle is not None:
+                await idlest.handle.close()
+            del self._files[idlest.path]
+
+        observed = ObservedFile(
+            path=path,
+            buffer=linebuffer.LineBuffer(self._backlog),
+            state=self.State.INIT,
+            last_active=time.monotonic(),
+        )
+        self._files[path] = observed
+
+        return observed
+
+    def _add_line(self, observed, line):
+        observed.buffer.append(line)
+        if self._tag_lines:
+            tag = os.path.relpath(observed.path, self._tag_root)
+            self._buffer.append(f"[{tag}] {line}")
+        else:
+            self._buffer.append(line)
+
+    async def _read_lines(self, observed):
         while True:
-            try:
-                f = await aiofiles.open(self._file_path, mode="r")
+            line = await observed.handle.readline()
+            if not line:
+                break
+
+            self._add_line(observed, line.strip())
+
+        observed.last_active = time.monotonic()
+        self._notifier.notify()
+        self._lines_notifier.notify()
+
+    async def _open_file(self, observed):
+        try:
+            offset = await self._find_tail_offset(observed.path)
+            observed.handle = await aiofiles.open(observed.path, mode="r")
+        except FileNotFoundError:
+            # Opened again when it's created
+            logger.warning(f"File {observed.path} vanished before being opened")
+            return
+
+        logger.debug(f"Seeking to pos {offset}")
+        await observed.handle.seek(offset)
+        await self._read_lines(observed)
+        observed.state = self.State.OPENED
+
+        logger.info(f"File {observed.path} opened successfully")
 
-                size = os.stat(self._file_path).st_size
-                if size > self.SKIP_FILESIZE_THRESHOLD:
-                    target = int(size * self.SKIP_PERCENT)
-                    logger.debug(f"Seeking to pos {target}")
-                    await f.seek(target)
-                else:
-                    logger.debug("Churning the entire file")
+    async def _find_tail_offset(self, path):
+        # Reads blocks backwards from the end until the start of the last
+        # backlog lines is found, so that the cost doesn't depend on the size
+        # of the file
+        async with aiofiles.open(path, mode="rb") as f:
+            # A newline as the last byte ends the last line, doesn't start one
+            position = max(await f.seek(0, os.SEEK_END) - 1, 0)
+            remaining = self._backlog
 
-                async for line in f:
-                    self._add_line(line.strip())
+            while position > 0:
+                size = min(self.TAIL_BLOCK_SIZE, position)
+                position -= size
+                await f.seek(position)
+                block = await f.read(size)
 
-                logger.info(f"File {self._file_path} opened successfully")
+                index = len(block)
+                while (index := block.rfind(b"\n", 0, index)) >= 0:
+                    remaining -= 1
+                    if remaining == 0:
+                        return position + index + 1
 
-                return f
-            except FileNotFoundError:
-                await asyncio.sleep(0.5)
+        return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+
+
+class TaskHistory:
+    """Records of the most recently completed tasks, optionally journaled"""
+
+    def __init__(self, size, journal=None):
+        self._records = collections.deque(maxlen=size)
+        self._journal = journal
+
+        if self._journal is not None:
+            self._records.extend(self._journal.load())
+            # Drop what fell off the backlog, keeping the journal bounded
+            self._journal.rewrite(self._records)
+
+    @property
+    def records(self):
+        return list(self._records)
+
+    def add(self, record):
+        self._records.append(record)
+
+        if self._journal is not None:
+            self._journal.append(record)
+            if self._journal.needs_compaction:
+                self._journal.rewrite(self._records)
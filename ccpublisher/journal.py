@@ -0,0 +1,94 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Append-only file of JSON records, one per line
+
+    Appends are written straight away but synced to disk in batches, at most
+    once every SYNC_DELAY seconds. Once COMPACTION_THRESHOLD records have been
+    appended since the last rewrite, needs_compaction tells the owner to
+    rewrite the journal with its current state.
+    """
+
+    SYNC_DELAY = 0.1
+    COMPACTION_THRESHOLD = 1000
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._path, "a")
+        self._sync_handle = None
+        self._appended = 0
+
+    @property
+    def needs_compaction(self):
+        return self._appended >= self.COMPACTION_THRESHOLD
+
+    def load(self):
+        records = []
+        with open(self._path) as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Most likely a record truncated by a crash
+                    logger.warning(f"Skipping malformed record {self._path}:{lineno}")
+
+        logger.info(f"Loaded {len(records)} records from {self._path}")
+
+        return records
+
+    def append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._appended += 1
+
+        if self._sync_handle is None:
+            self._sync_handle = asyncio.get_running_loop().call_later(
+                self.SYNC_DELAY, self.sync
+            )
+
+    def rewrite(self, records):
+        """Atomically replace the contents of the journal with the given records"""
+        self.sync()
+        self._file.close()
+
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+        self._file = open(self._path, "a")
+        self._appended = 0
+
+    def sync(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
@@ -0,0 +1,74 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import itertools
+
+
+class LineBuffer:
+    """Bounded buffer retaining the most recent lines of a text stream
+
+    Every line appended gets a sequence number, starting from 1 and
+    increasing monotonically, which is kept after older lines are evicted.
+    """
+
+    def __init__(self, maxlen):
+        self._lines = collections.deque(maxlen=maxlen)
+        self._last_seq = 0
+
+    @property
+    def lines(self):
+        return list(self._lines)
+
+    @property
+    def last_seq(self):
+        """Sequence number of the most recent line, 0 if none was appended"""
+        return self._last_seq
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest line retained"""
+        return self._last_seq - len(self._lines) + 1
+
+    def append(self, line):
+        self._lines.append(line)
+        self._last_seq += 1
+
+    def tail(self, count):
+        if count >= len(self._lines):
+            return self.lines
+
+        return list(self._lines)[-count:]
+
+    def since(self, seq):
+        """Lines appended after the line with the given sequence number
+
+        Returns the lines and whether some lines following seq have already
+        been evicted (or seq is unknown, as it is from before a restart).
+        """
+        if seq > self._last_seq:
+            return self.lines, True
+
+        start = max(seq + 1 - self.first_seq, 0)
+        truncated = seq + 1 < self.first_seq
+
+        return list(itertools.islice(self._lines, start, None)), truncated
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __json_repr__(self):
+        return self.lines
@@ -0,0 +1,150 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import contextlib
+import time
+
+
+class Registry:
+    """Collection of metrics, exposed in the Prometheus text format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self._metrics = {}
+        self._collect_hooks = []
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+
+        self._metrics[metric.name] = metric
+
+    def add_collect_hook(self, hook):
+        """Register a function bringing metrics up to date before each exposition"""
+        self._collect_hooks.append(hook)
+
+    def expose(self):
+        for hook in self._collect_hooks:
+            hook()
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, labels, value in metric.collect():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ""
+
+        pairs = ",".join(
+            f'{name}="{self._escape(value)}"' for name, value in labels.items()
+        )
+        return f"{{{pairs}}}"
+
+    def _escape(self, value):
+        return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self._labels = tuple(labels)
+        # Tuple of label values -> value
+        self._values = {}
+        registry.register(self)
+
+    def collect(self):
+        for key, value in self._values.items():
+            yield self.name, self._get_labels(key), value
+
+    def _get_key(self, labels):
+        return tuple(str(labels[name]) for name in self._labels)
+
+    def _get_labels(self, key):
+        return dict(zip(self._labels, key))
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._get_key(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labels=(),
+        buckets=DEFAULT_BUCKETS,
+        registry=REGISTRY,
+    ):
+        super().__init__(name, documentation, labels, registry)
+        self._buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        if key not in self._values:
+            # Per bucket (the last one being +Inf) counts, and sum
+            self._values[key] = [[0] * (len(self._buckets) + 1), 0]
+
+        counts, _ = entry = self._values[key]
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        for key, (counts, total) in self._values.items():
+            labels = self._get_labels(key)
+            cumulative = 0
+            for bound, count in zip([*self._buckets, "+Inf"], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative
+
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
@@ -0,0 +1,46 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+
+
+class ChangeNotifier:
+    """Versions the state of the service and wakes up who waits for changes"""
+
+    def __init__(self):
+        self._version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def version(self):
+        return self._version
+
+    def notify(self):
+        self._version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, version, timeout=None):
+        """Wait until the version moves past the given one and return it
+
+        Raises asyncio.TimeoutError if nothing changes within the timeout.
+        """
+        if self._version != version:
+            return self._version
+
+        await asyncio.wait_for(self._changed.wait(), timeout)
+
+        return self._version
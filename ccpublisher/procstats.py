@@ -0,0 +1,145 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+@dataclass
+class ProcessSample:
+    rss: int = 0
+    cpu_time: float = 0
+    threads: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+
+
+@dataclass
+class ProcessStats:
+    peak_rss: int = 0
+    cpu_time: float = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    peak_threads: int = 0
+
+
+def read_group(pgid):
+    """Sample the processes of a process group from /proc, by PID"""
+    samples = {}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The command name may contain spaces, fields are counted after it
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+
+            sample = ProcessSample(
+                rss=int(fields[21]) * PAGE_SIZE,
+                cpu_time=(int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+                threads=int(fields[17]),
+            )
+        except (OSError, IndexError, ValueError):
+            # The process is gone or isn't readable
+            continue
+
+        try:
+            with open(f"/proc/{pid}/io") as f:
+                io = dict(line.split(": ") for line in f.read().splitlines())
+            sample.read_bytes = int(io["read_bytes"])
+            sample.write_bytes = int(io["write_bytes"])
+        except (OSError, KeyError, ValueError):
+            pass
+
+        samples[int(pid)] = sample
+
+    return samples
+
+
+class GroupSampler:
+    """Samples the resource usage of a process group while in its context
+
+    Memory and threads are peaks of the totals of the group, CPU time and
+    I/O bytes are accumulated over every process seen, minus what processes
+    already running when entering the context had used before. Usage of
+    processes living shorter than the sampling interval is missed.
+    """
+
+    INTERVAL = 1.0
+
+    def __init__(self, pgid, stats=None):
+        self._pgid = pgid
+        self._stats = stats or ProcessStats()
+        self._baseline = {}
+        self._last = {}
+        self._sampling = None
+
+    @property
+    def stats(self):
+        return self._stats
+
+    async def __aenter__(self):
+        self._baseline = read_group(self._pgid)
+        self._last = dict(self._baseline)
+        self._sampling = asyncio.create_task(self._sampling_task())
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._sampling.cancel()
+        try:
+            await self._sampling
+        except asyncio.CancelledError:
+            pass
+
+        self.sample()
+
+    def sample(self):
+        samples = read_group(self._pgid)
+        self._last.update(samples)
+
+        stats = self._stats
+        stats.peak_rss = max(stats.peak_rss, sum(s.rss for s in samples.values()))
+        stats.peak_threads = max(
+            stats.peak_threads, sum(s.threads for s in samples.values())
+        )
+        stats.cpu_time = self._get_usage("cpu_time")
+        stats.read_bytes = self._get_usage("read_bytes")
+        stats.write_bytes = self._get_usage("write_bytes")
+
+    def _get_usage(self, name):
+        return sum(
+            getattr(sample, name)
+            - getattr(self._baseline.get(pid, ProcessSample()), name)
+            for pid, sample in self._last.items()
+        )
+
+    async def _sampling_task(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Error while sampling process group {self._pgid}:")
+                logger.exception(e)
+
+            await asyncio.sleep(self.INTERVAL)
@@ -17,11 +17,15 @@
 import asyncio
 import datetime
 import hashlib
+import time
 from dataclasses import dataclass
 import logging
 
 import atwc
 
+from ccpublisher import twcclient
+from ccpublisher.notifier import ChangeNotifier
+
 
 logger = logging.getLogger(__name__)
 
@@ -59,99 +63,299 @@ class Profile:
     is_stale: bool = True
     _manager = None
 
+    @property
+    def commit_id(self):
+        """ID of the last commit of the MD resource, None if unknown"""
+        if self.md is None or self.md.last_commit is None:
+            return None
+
+        return self.md.last_commit.id
+
     async def refresh(self):
         await self._manager.refresh_profile(self)
 
 
-class LockedError(Exception):
-    pass
+class QualifiedNameResolver:
+    """Resolves qualified names of elements in batches
+
+    Owners are fetched level by level with a single batch request per level,
+    and are cached so that elements sharing part of their owner chain (even
+    across different resources) are only fetched once.
+    """
+
+    def __init__(self):
+        # Element ID -> (name, owning package ID)
+        self._owners = {}
+
+    async def get_qualified_names(self, model_browser, elements):
+        pending = {
+            owner_id
+            for owner_id in map(self._get_owner_id, elements.values())
+            if owner_id is not None and owner_id not in self._owners
+        }
+
+        while pending:
+            owners = await model_browser.get_elements_batch(pending)
+            pending = set()
+            for owner_id, owner in owners.items():
+                owner_data = owner["data"][1]
+                parent_id = self._get_owner_id(owner_data)
+                self._owners[owner_id] = (
+                    owner_data["kerml:esiData"]["name"],
+                    parent_id,
+                )
+                if parent_id is not None and parent_id not in self._owners:
+                    pending.add(parent_id)
+
+        return [self._get_qualified_name(element) for element in elements.values()]
+
+    def _get_qualified_name(self, element):
+        names = [element["kerml:esiData"]["name"]]
+        owner_id = self._get_owner_id(element)
+
+        while owner_id in self._owners:
+            name, owner_id = self._owners[owner_id]
+            # The root element (model) is not part of the qualified name
+            if owner_id is None:
+                break
+            names.append(name)
+
+        return "::".join(reversed(names))
+
+    def _get_owner_id(self, element):
+        owning_package = element["kerml:esiData"]["owningPackage"]
+        if owning_package is None:
+            return None
+
+        return atwc.utils.extract_ids(owning_package)[0]
 
 
 class ProfilesManager:
     CCPUB_STEREOTYPE_NAME = "ccPublisher"
 
-    def __init__(self, api_url, login, password):
-        self._client = atwc.client.Client(
-            api_url=api_url, login=login, password=password
+    def __init__(
+        self,
+        api_url,
+        login,
+        password,
+        max_concurrency=4,
+        connection_limit=8,
+        notifier=None,
+    ):
+        self._client = twcclient.Client(
+            api_url=api_url,
+            login=login,
+            password=password,
+            connection_limit=connection_limit,
         )
+        self._notifier = notifier or ChangeNotifier()
+        self._max_concurrency = max_concurrency
         self._profiles = []
+        # Profile ID -> Profile
+        self._profiles_by_id = {}
+        # Resource ID -> (modifiedDate, Resource)
+        self._resources_cache = {}
         self._lock = asyncio.Lock()
+        # Refresh scope -> task running it, shared by concurrent callers
+        self._inflight = {}
+        # Monotonic time of the last completed refresh
+        self._refreshed_at = 0
+        self._revalidation = None
+        self._version = 0
+        # Contents of the profiles at the current version
+        self._signature = None
 
     @property
     def profiles(self):
         return self._profiles
 
+    @property
+    def version(self):
+        """Incremented whenever a refresh changes the profiles"""
+        return self._version
+
     def get_profile(self, profile_id):
-        for profile in self._profiles:
-            if profile.id == profile_id:
-                return profile
+        return self._profiles_by_id.get(profile_id)
 
-        return None
+    async def close(self):
+        await self._client.close()
 
     async def fetch_all_profiles(self):
-        if self._lock.locked():
-            raise LockedError("A refresh is already taking place")
+        await self._single_flight("all", self._fetch_all_profiles)
 
+    async def refresh_known_profiles(self):
+        # A full refresh covers the known profiles as well
+        if "all" in self._inflight:
+            await self._single_flight("all", self._fetch_all_profiles)
+        else:
+            await self._single_flight("known", self._refresh_known_profiles)
+
+    async def refresh_profile(self, profile):
+        if "all" in self._inflight:
+            await self._single_flight("all", self._fetch_all_profiles)
+
+            # The full refresh assembles new profiles, the one given is updated
+            # from its counterpart (unless the profile is gone)
+            refreshed = self.get_profile(profile.id)
+            if refreshed is not None:
+                profile.md = refreshed.md
+                profile.cc = refreshed.cc
+                profile.stereo_data = refreshed.stereo_data
+                profile.is_stale = refreshed.is_stale
+                return
+
+        await self._single_flight(
+            ("profile", profile.id), lambda: self._refresh_profile(profile)
+        )
+
+    def revalidate(self, max_age):
+        """Refresh the known profiles in background if older than max_age
+
+        Returns the refresh in progress, shared by all the callers until it
+        completes, or None if the profiles are fresh enough.
+        """
+        if (
+            self._revalidation is None
+            and time.monotonic() - self._refreshed_at > max_age
+        ):
+            self._revalidation = asyncio.create_task(self._revalidate())
+
+        return self._revalidation
+
+    async def _single_flight(self, scope, refresh):
+        # Callers asking for a refresh of a scope already in progress wait for
+        # it instead of starting another one. Shielded, so that a caller being
+        # cancelled doesn't cancel the refresh for the others.
+        task = self._inflight.get(scope)
+        if task is None:
+            task = asyncio.create_task(refresh())
+            self._inflight[scope] = task
+            task.add_done_callback(lambda _: self._inflight.pop(scope, None))
+
+        return await asyncio.shield(task)
+
+    async def _fetch_all_profiles(self):
         async with self._lock:
             logger.info("Fetching all profiles")
-            profiles = []
             async with self._client.create_session():
                 resource_browser = atwc.browsers.ResourceBrowser(self._client)
                 await resource_browser.fetch()
 
-                for md_resource in resource_browser.md_resources:
-                    logger.info(f"Scanning MD resource: {md_resource['dcterms:title']}")
-                    stereo_data = await self._get_ccpub_stereo_data(md_resource)
-                    if stereo_data is None:
-                        continue
-
-                    profile = Profile()
-                    profile._manager = self
-                    await self._populate_profile(
-                        md_resource, profile, resource_browser, stereo_data
-                    )
+                cc_index = self._index_resources(resource_browser.cc_resources)
+                semaphore = asyncio.Semaphore(self._max_concurrency)
+                qn_resolver = QualifiedNameResolver()
+                profiles = await asyncio.gather(
+                    *[
+                        self._scan_resource(
+                            md_resource,
+                            resource_browser,
+                            cc_index,
+                            semaphore,
+                            qn_resolver,
+                        )
+                        for md_resource in resource_browser.md_resources
+                    ]
+                )
 
-                    profiles.append(profile)
+                self._prune_resources_cache(resource_browser)
 
-            self._profiles = sorted(
-                profiles, key=lambda p: (p.md.category_path + p.md.name).lower()
+            self._set_profiles(
+                sorted(
+                    [p for p in profiles if p is not None],
+                    key=lambda p: ((p.md.category_path + p.md.name).lower(), p.id),
+                )
             )
 
+            self._refreshed_at = time.monotonic()
+            self._profiles_changed()
+
             logger.info(f"Assembled {len(self._profiles)} profiles")
 
-    async def refresh_known_profiles(self):
+    async def _refresh_known_profiles(self):
         profiles = []
         async with self._lock:
             async with self._client.create_session():
                 resource_browser = atwc.browsers.ResourceBrowser(self._client)
                 await resource_browser.fetch()
 
+                md_index = self._index_resources(resource_browser.md_resources)
+                cc_index = self._index_resources(resource_browser.cc_resources)
                 for profile in self._profiles:
-                    md_resource = self._find_resource(
-                        resource_browser.md_resources, profile.md.name
-                    )
+                    md_resource = md_index.get(profile.md.name)
+                    if md_resource is None:
+                        # Found again by a full refresh, if it's been renamed
+                        logger.warning(
+                            f"MD resource {profile.md.name} is gone, "
+                            f"dropping its profile"
+                        )
+                        continue
+
                     await self._populate_profile(
-                        md_resource, profile, resource_browser, None
+                        md_resource,
+                        profile,
+                        resource_browser,
+                        cc_index,
+                        None,
                     )
                     profiles.append(profile)
 
-        self._profiles = profiles
+        self._set_profiles(profiles)
+        self._refreshed_at = time.monotonic()
+        self._profiles_changed()
 
-    async def refresh_profile(self, profile):
+    async def _refresh_profile(self, profile):
         async with self._lock:
             async with self._client.create_session():
                 resource_browser = atwc.browsers.ResourceBrowser(self._client)
                 await resource_browser.fetch()
 
-                md_resource = self._find_resource(
-                    resource_browser.md_resources, profile.md.name
-                )
+                md_index = self._index_resources(resource_browser.md_resources)
+                cc_index = self._index_resources(resource_browser.cc_resources)
+                md_resource = md_index.get(profile.md.name)
 
                 stereo_data = await self._get_ccpub_stereo_data(md_resource)
 
                 await self._populate_profile(
-                    md_resource, profile, resource_browser, stereo_data
+                    md_resource, profile, resource_browser, cc_index, stereo_data
+                )
+
+            self._profiles_changed()
+
+    async def _revalidate(self):
+        try:
+            await self.refresh_known_profiles()
+        except Exception as e:
+            logger.error("Error while refreshing the profiles in background:")
+            logger.exception(e)
+        finally:
+            self._revalidation = None
+
+    async def _scan_resource(
+        self, md_resource, resource_browser, cc_index, semaphore, qn_resolver
+    ):
+        async with semaphore:
+            logger.info(f"Scanning MD resource: {md_resource['dcterms:title']}")
+            try:
+                stereo_data = await self._get_ccpub_stereo_data(
+                    md_resource, qn_resolver
                 )
+                if stereo_data is None:
+                    return None
+
+                profile = Profile()
+                profile._manager = self
+                await self._populate_profile(
+                    md_resource, profile, resource_browser, cc_index, stereo_data
+                )
+            except Exception as e:
+                logger.error(
+                    f"Error while scanning MD resource "
+                    f"{md_resource['dcterms:title']}, skipping it:"
+                )
+                logger.exception(e)
+                return None
+
+            return profile
 
     def _is_stale(self, md, cc):
         return bool(cc is None or md.modified > cc.modified)
@@ -160,12 +364,10 @@ class ProfilesManager:
         return hashlib.md5(name.encode()).hexdigest()
 
     async def _populate_profile(
-        self, md_resource, profile, resource_browser, stereo_data
+        self, md_resource, profile, resource_browser, cc_index, stereo_data
     ):
         profile.md = await self._get_resource_data(resource_browser, md_resource)
-        cc_resource = self._find_resource(
-            resource_browser.cc_resources, profile.md.name
-        )
+        cc_resource = cc_index.get(profile.md.name)
         if cc_resource is None:
             logger.warning(
                 f"MD Resource {md_resource['dcterms:title']} "
@@ -184,6 +386,10 @@ class ProfilesManager:
         if resource is None:
             return None
 
+        cached = self._resources_cache.get(resource["ID"])
+        if cached is not None and cached[0] == resource["modifiedDate"]:
+            return cached[1]
+
         created = datetime.datetime.fromtimestamp(resource["createdDate"])
         modified = datetime.datetime.fromtimestamp(resource["modifiedDate"])
         category_path = await resource_browser.get_category_path(resource)
@@ -197,7 +403,7 @@ class ProfilesManager:
             message=revision_info["description"],
         )
 
-        return Resource(
+        resource_data = Resource(
             id=resource["ID"],
             name=self._strip_extension(resource["dcterms:title"]),
             created=created,
@@ -205,15 +411,43 @@ class ProfilesManager:
             category_path=category_path,
             last_commit=commit_info,
         )
+        self._resources_cache[resource["ID"]] = (
+            resource["modifiedDate"],
+            resource_data,
+        )
+
+        return resource_data
 
-    def _find_resource(self, resources, resource_name):
+    def _prune_resources_cache(self, resource_browser):
+        existing_ids = {r["ID"] for r in resource_browser.all_resources}
+        for resource_id in list(self._resources_cache):
+            if resource_id not in existing_ids:
+                del self._resources_cache[resource_id]
+
+    def _index_resources(self, resources):
+        # Name -> resource, the first one winning as names should be unique
+        index = {}
         for resource in resources:
-            if self._strip_extension(resource["dcterms:title"]) == resource_name:
-                return resource
+            index.setdefault(self._strip_extension(resource["dcterms:title"]), resource)
+
+        return index
+
+    def _profiles_changed(self):
+        # Unchanged resources are cached, comparing them is cheap
+        signature = [
+            (p.id, p.md, p.cc, p.stereo_data, p.is_stale) for p in self._profiles
+        ]
+        if signature != self._signature:
+            self._signature = signature
+            self._version += 1
 
-        return None
+        self._notifier.notify()
 
-    async def _get_ccpub_stereo_data(self, resource):
+    def _set_profiles(self, profiles):
+        self._profiles = profiles
+        self._profiles_by_id = {profile.id: profile for profile in profiles}
+
+    async def _get_ccpub_stereo_data(self, resource, qn_resolver=None):
         model_browser = atwc.browsers.ModelBrowser(self._client, resource)
 
         model = await model_browser.get_model_root()
@@ -240,10 +474,12 @@ class ProfilesManager:
         scope_ids = atwc.utils.extract_ids(tagged_values["scope"])
         scope_elements = await model_browser.get_elements_batch(scope_ids)
 
-        scope_qns = [
-            await model_browser.get_qualified_name(scope["data"][1])
-            for scope in scope_elements.values()
-        ]
+        if qn_resolver is None:
+            qn_resolver = QualifiedNameResolver()
+        scope_qns = await qn_resolver.get_qualified_names(
+            model_browser,
+            {scope_id: scope["data"][1] for scope_id, scope in scope_elements.items()},
+        )
         scope_str = ";".join(scope_qns)
 
         template_id = atwc.utils.extract_ids(tagged_values["template"])[0]
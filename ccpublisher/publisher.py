@@ -22,24 +22,64 @@ import tempfile
 import enum
 import time
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 
 from jinja2 import Template
 
-from ccpublisher import queue
+from ccpublisher import (
+    queue,
+    linebuffer,
+    journal,
+    history,
+    runner,
+    procstats,
+    metrics,
+)
+from ccpublisher.notifier import ChangeNotifier
 from ccpublisher.profile import Profile
 
 logger = logging.getLogger(__name__)
 
+PUBLISH_DURATION = metrics.Histogram(
+    "ccpublisher_publish_duration_seconds",
+    "Duration of the publishing sessions, by profile and outcome",
+    labels=("profile", "outcome"),
+    buckets=(30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200),
+)
+WORKER_STATE_TIME = metrics.Counter(
+    "ccpublisher_worker_state_seconds_total",
+    "Time spent by the workers in each state",
+    labels=("state",),
+)
+
 
 @dataclass
 class PublisherTask:
+    class Outcome(enum.Enum):
+        PUBLISHED = enum.auto()
+        FAILED = enum.auto()
+        UP_TO_DATE = enum.auto()
+
+    class Pin(enum.Enum):
+        FIRST = enum.auto()
+        LAST = enum.auto()
+
     profile: Profile
+    task_id: int = None
+    priority: int = 0
+    deadline: float = None
+    enqueue_time: float = 0
+    force: bool = False
+    pin: Pin = None
+    commit_id: int = None
+    outcome: Outcome = None
     returncode: int = None
-    stdout: str = None
-    stderr: str = None
+    stdout: linebuffer.LineBuffer = field(default=None, repr=False)
+    stderr: linebuffer.LineBuffer = field(default=None, repr=False)
+    output_file: str = None
     start_time: float = 0
     end_time: float = 0
+    stats: procstats.ProcessStats = None
 
     @property
     def elapsed(self):
@@ -48,10 +88,41 @@ class PublisherTask:
         else:
             return self.end_time - self.start_time
 
+    def summary(self):
+        return {
+            "task_id": self.task_id,
+            "profile_id": self.profile.id,
+            "project": f"{self.profile.md.category_path}/{self.profile.md.name}",
+            "outcome": self.outcome.name if self.outcome else None,
+            "returncode": self.returncode,
+            "output_file": self.output_file,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "elapsed": self.elapsed,
+            "stats": asdict(self.stats) if self.stats else None,
+        }
+
     def __json_repr__(self):
+        # The output is served separately by the task output endpoint, as are
+        # the elapsed time and stats while running: they change all the time,
+        # and would go stale in the status, which is only encoded on changes
+        running = self.end_time == 0
         return {
-            **asdict(self),
-            **{a: getattr(self, a) for a in dir(self) if a[0] != "_"},
+            "profile": self.profile,
+            "task_id": self.task_id,
+            "priority": self.priority,
+            "deadline": self.deadline,
+            "enqueue_time": self.enqueue_time,
+            "force": self.force,
+            "pin": self.pin,
+            "commit_id": self.commit_id,
+            "outcome": self.outcome,
+            "returncode": self.returncode,
+            "output_file": self.output_file,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "elapsed": None if running else self.elapsed,
+            "stats": None if running else self.stats,
         }
 
 
@@ -62,26 +133,106 @@ class Publisher:
         REFRESHING = enum.auto()
         RUNNING = enum.auto()
 
-    def __init__(self, template, auth, script, max_tasks):
-        self._queue = queue.RAQueue(max_tasks)
+    # Seconds between attempts to restore the persisted tasks whose profile
+    # was not known at startup (for instance, its scan failed)
+    RESTORE_RETRY_INTERVAL = 60
+
+    def __init__(
+        self,
+        template,
+        auth,
+        script,
+        max_tasks,
+        workers=1,
+        output_backlog=100,
+        output_dir=None,
+        state_dir=None,
+        get_profile=None,
+        history_size=100,
+        aging_interval=3600,
+        skip_up_to_date=False,
+        runner=None,
+        notifier=None,
+    ):
+        self._notifier = notifier or ChangeNotifier()
         self._template = Template(open(template).read())
         self._auth = auth
         self._script = Path(script)
-        self._current_task = None
-        self._process = None
+        self._output_backlog = output_backlog
+        self._output_dir = Path(output_dir) if output_dir else None
+        self._get_profile = get_profile
+        self._aging_interval = aging_interval
+        self._skip_up_to_date = skip_up_to_date
         self._last_task = None
-        self._proc_started_ts = 0
-        self._state = self.State.INIT
+
+        if state_dir:
+            state_dir = Path(state_dir)
+            self._queue = queue.PersistentRAQueue(
+                max_tasks,
+                journal=journal.Journal(state_dir / "queue.journal"),
+                encode=self._encode_task,
+                decode=self._decode_task,
+                notifier=self._notifier,
+                sort_key=self._schedule_key,
+                is_ready=self._is_ready,
+                index_key=self._get_profile_id,
+            )
+            self._history = history.TaskHistory(
+                history_size, journal=journal.Journal(state_dir / "history.journal")
+            )
+        else:
+            self._queue = queue.RAQueue(
+                max_tasks,
+                notifier=self._notifier,
+                sort_key=self._schedule_key,
+                is_ready=self._is_ready,
+                index_key=self._get_profile_id,
+            )
+            self._history = history.TaskHistory(history_size)
+
+        # Profile ID -> duration of its last successful publishing
+        self._durations = {
+            record["profile_id"]: record["elapsed"]
+            for record in self._history.records
+            if record["returncode"] == 0
+        }
+        self._mean_duration = self._get_mean_duration()
+
+        self._workers = [
+            PublisherWorker(self, worker_id, runner) for worker_id in range(workers)
+        ]
+        # Otherwise the time spent in a state is only accounted when leaving it
+        metrics.REGISTRY.add_collect_hook(self._account_state_times)
         logger.info(f"Loaded template file {template}")
 
+    @property
+    def state(self):
+        states = {worker.state for worker in self._workers}
+        for state in (self.State.RUNNING, self.State.REFRESHING, self.State.IDLE):
+            if state in states:
+                return state
+
+        return self.State.INIT
+
     def start(self):
-        return asyncio.create_task(self._publisher_task(), name="Publisher task")
+        tasks = [worker.start() for worker in self._workers]
+        if isinstance(self._queue, queue.PersistentRAQueue):
+            tasks.append(
+                asyncio.create_task(self._restore_task(), name="Task restore task")
+            )
+
+        return tasks
 
     def get_current_status(self):
+        running_tasks = [
+            worker.current_task for worker in self._workers if worker.current_task
+        ]
+
         return {
-            "state": self._state.name,
+            "state": self.state.name,
             "last_task": self._last_task,
-            "current_task": self._current_task,
+            "current_task": running_tasks[0] if running_tasks else None,
+            "workers": [worker.get_status() for worker in self._workers],
             "queue": self.get_enqueued_tasks(),
         }
 
@@ -91,9 +242,66 @@ class Publisher:
             for taskdata in self._queue.entries
         ]
 
-    def publish(self, profile):
-        task = PublisherTask(profile=profile)
-        return self._queue.put(task)
+    def get_task(self, task_id):
+        for worker in self._workers:
+            if worker.current_task and worker.current_task.task_id == task_id:
+                return worker.current_task
+
+        # Each worker keeps its last completed task, which might be not the
+        # most recent one overall
+        for worker in self._workers:
+            if worker.last_task and worker.last_task.task_id == task_id:
+                return worker.last_task
+
+        return None
+
+    def get_history(self, limit=None):
+        records = self._history.records
+        return records[-limit:] if limit else records
+
+    def publish(self, profile, priority=0, deadline=None, force=False):
+        """Enqueue a publishing task for the profile
+
+        Returns the ID of the task and whether it has been created. Requests
+        for a profile that is already enqueued are merged into the existing
+        task, since it publishes the latest commit anyway. Requests for a
+        profile being published are dropped, unless the commit they were
+        made for is not the one being published: then a single task to
+        rerun the publishing afterwards is enqueued.
+
+        Forced tasks are published even when skip_up_to_date is enabled and
+        the CC resource is already newer than the MD one.
+        """
+        found = self._queue.find(profile.id)
+        if found is not None:
+            task_id, task = found
+            task.priority = max(task.priority, priority)
+            task.force = task.force or force
+            if deadline is not None:
+                task.deadline = min(task.deadline or deadline, deadline)
+            self._queue.update(task_id)
+            logger.info(f"Merged publishing request into enqueued task {task_id}")
+
+            return task_id, False
+
+        running_task = self._get_running_task(profile.id)
+        if running_task is not None and running_task.commit_id in (
+            None,
+            profile.commit_id,
+        ):
+            logger.info(
+                f"Dropped publishing request, task {running_task.task_id} "
+                f"is already publishing the same commit"
+            )
+
+            return running_task.task_id, False
+
+        task = self._create_task(
+            profile, priority=priority, deadline=deadline, force=force
+        )
+        task.task_id = self._queue.put(task)
+
+        return task.task_id, True
 
     def remove_task(self, task_id):
         try:
@@ -103,46 +311,308 @@ class Publisher:
         else:
             return True
 
+    def move_task(self, task_id, position):
+        """Move an enqueued task to the given position of the listed queue
+
+        The queue lists first the tasks pinned first, then the ones ordered
+        by their scheduling rank and last the ones pinned last. A task moved
+        among the pinned ones is pinned at that position, while one moved
+        amid the ranked ones is unpinned and ranked again.
+        """
+        try:
+            task = self._queue.lookup(task_id)
+        except self._queue.NotFoundError:
+            return False
+
+        groups = {PublisherTask.Pin.FIRST: [], None: [], PublisherTask.Pin.LAST: []}
+        for entry_id, entry in self._queue.entries:
+            if entry_id != task_id:
+                groups[entry.pin].append(entry_id)
+        first, ranked, last = groups.values()
+
+        if position <= len(first):
+            pin, group, index = PublisherTask.Pin.FIRST, first, max(position, 0)
+        elif position >= len(first) + len(ranked):
+            pin, group = PublisherTask.Pin.LAST, last
+            index = position - len(first) - len(ranked)
+        else:
+            # The order of the ranked tasks changes over time, no pinning there
+            pin, group, index = None, [], 0
+
+        task.pin = pin
+        self._queue.update(task_id)
+        # Tasks pinned alike have the same rank, the queue order breaks the ties
+        if index < len(group):
+            self._queue.move_next_to(task_id, group[index])
+        elif group:
+            self._queue.move_next_to(task_id, group[-1], after=True)
+
+        return True
+
     def remove_all_tasks(self):
         self._queue.clear()
 
-    def terminate_running_task(self):
-        if self._current_task:
-            logger.info("Terminating current task")
-            os.killpg(os.getpgid(self._process.pid), signal.SIGTERM)
-            return True
+    def terminate_running_task(self, worker_id=None):
+        if worker_id is None:
+            workers = self._workers
+        elif 0 <= worker_id < len(self._workers):
+            workers = [self._workers[worker_id]]
         else:
             return False
 
-    async def _publisher_task(self):
-        self._state = self.State.IDLE
-
-        while True:
-            task = await self._queue.get()
+        # Not short-circuiting: every selected worker has to be signalled
+        terminated = [worker.terminate() for worker in workers]
+        return any(terminated)
+
+    def _create_task(
+        self,
+        profile,
+        task_id=None,
+        priority=0,
+        deadline=None,
+        enqueue_time=None,
+        force=False,
+        pin=None,
+    ):
+        return PublisherTask(
+            profile=profile,
+            task_id=task_id,
+            priority=priority,
+            deadline=deadline,
+            enqueue_time=enqueue_time or time.time(),
+            force=force,
+            pin=pin,
+            stdout=linebuffer.LineBuffer(self._output_backlog),
+            stderr=linebuffer.LineBuffer(self._output_backlog),
+        )
+
+    def _get_running_task(self, profile_id):
+        for worker in self._workers:
+            task = worker.current_task
+            if task is not None and task.profile.id == profile_id:
+                return task
+
+        return None
+
+    def _get_known_profile(self, profile):
+        known = self._get_profile(profile.id) if self._get_profile else None
+        return known or profile
+
+    def _get_profile_id(self, task):
+        return task.profile.id
+
+    def _is_ready(self, task):
+        # The same profile can't be published by two workers at once
+        return self._get_running_task(task.profile.id) is None
+
+    def _encode_task(self, task):
+        return {
+            "profile_id": task.profile.id,
+            "priority": task.priority,
+            "deadline": task.deadline,
+            "enqueue_time": task.enqueue_time,
+            "force": task.force,
+            "pin": task.pin.name if task.pin else None,
+        }
 
+    def _decode_task(self, task_id, data):
+        profile = self._get_profile(data["profile_id"])
+        if profile is None:
+            return None
+
+        return self._create_task(
+            profile,
+            task_id,
+            priority=data.get("priority", 0),
+            deadline=data.get("deadline", None),
+            enqueue_time=data.get("enqueue_time", None),
+            force=data.get("force", False),
+            pin=PublisherTask.Pin[data["pin"]] if data.get("pin") else None,
+        )
+
+    def _get_mean_duration(self):
+        if not self._durations:
+            return 0
+
+        return sum(self._durations.values()) / len(self._durations)
+
+    def _estimate_duration(self, profile_id):
+        # Never published: assume an average one
+        return self._durations.get(profile_id, self._mean_duration)
+
+    def _schedule_key(self, task):
+        # Tasks pinned first by moving them go first, and the ones pinned last
+        # go last, in queue order. In between, the ones that would miss their
+        # deadline if not started now come first, earliest deadline first. The
+        # others are ordered by priority, raised by one for every
+        # aging_interval spent waiting so that none starves, and then shortest
+        # estimated duration first.
+        if task.pin == PublisherTask.Pin.FIRST:
+            return (0,)
+        elif task.pin == PublisherTask.Pin.LAST:
+            return (2,)
+
+        now = time.time()
+        estimate = self._estimate_duration(task.profile.id)
+        urgent = task.deadline is not None and task.deadline - now <= estimate
+        priority = task.priority + int(
+            (now - task.enqueue_time) // self._aging_interval
+        )
+
+        return (1, not urgent, task.deadline if urgent else 0, -priority, estimate)
+
+    async def _restore_task(self):
+        while self._queue.unrestored_count:
+            await asyncio.sleep(self.RESTORE_RETRY_INTERVAL)
             try:
-                await self._publish(task)
+                self._queue.retry_restore()
             except Exception as e:
-                logger.error("Error while attempting to publish:")
+                logger.error("Error while restoring the persisted tasks:")
                 logger.exception(e)
-            finally:
-                self._state = self.State.IDLE
+
+    def _account_state_times(self):
+        for worker in self._workers:
+            worker.account_state_time()
+
+    def _task_done(self, task):
+        self._queue.task_done(task.task_id)
+        if task.start_time and not task.end_time:
+            task.end_time = time.time()
+        if task.outcome is None:
+            # The publishing has been interrupted by an error
+            task.outcome = PublisherTask.Outcome.FAILED
+        self._history.add(task.summary())
+        if task.start_time and task.outcome != PublisherTask.Outcome.UP_TO_DATE:
+            PUBLISH_DURATION.observe(
+                task.elapsed, profile=task.profile.md.name, outcome=task.outcome.name
+            )
+        if task.returncode == 0:
+            self._durations[task.profile.id] = task.elapsed
+            self._mean_duration = self._get_mean_duration()
+
+
+class PublisherWorker:
+    def __init__(self, publisher, worker_id, runner_options=None):
+        self._publisher = publisher
+        self._id = worker_id
+        self._runner = (
+            runner.WarmRunner(name=f"runner #{worker_id}", **runner_options)
+            if runner_options
+            else None
+        )
+        self._current_task = None
+        self._last_task = None
+        self._process = None
+        self._proc_started_ts = 0
+        self._state = Publisher.State.INIT
+        self._state_since = time.monotonic()
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def current_task(self):
+        return self._current_task
+
+    @property
+    def last_task(self):
+        return self._last_task
+
+    def start(self):
+        return asyncio.create_task(
+            self._publisher_task(), name=f"Publisher task #{self._id}"
+        )
+
+    def get_status(self):
+        return {
+            "worker_id": self._id,
+            "state": self._state.name,
+            "current_task": self._current_task,
+        }
+
+    def terminate(self):
+        if self._current_task and self._process:
+            logger.info(f"Terminating current task on worker #{self._id}")
+            os.killpg(os.getpgid(self._process.pid), signal.SIGTERM)
+            return True
+        else:
+            return False
+
+    def _set_last_task(self, task):
+        self._last_task = task
+        self._publisher._last_task = task
+
+    def account_state_time(self):
+        now = time.monotonic()
+        WORKER_STATE_TIME.inc(now - self._state_since, state=self._state.name)
+        self._state_since = now
+
+    def _set_state(self, state):
+        self.account_state_time()
+        self._state = state
+        self._publisher._notifier.notify()
+
+    async def _publisher_task(self):
+        self._set_state(Publisher.State.IDLE)
+
+        try:
+            while True:
+                task = await self._publisher._queue.get()
+
+                try:
+                    await self._publish(task)
+                except Exception as e:
+                    logger.error(
+                        f"Error while attempting to publish on worker #{self._id}:"
+                    )
+                    logger.exception(e)
+                finally:
+                    self._current_task = None
+                    self._process = None
+                    self._set_state(Publisher.State.IDLE)
+
+                # Not reached when cancelled: the task is then resumed on restart
+                self._publisher._task_done(task)
+        finally:
+            # The runner lives in its own session and would outlive the service
+            if self._runner is not None:
+                await self._runner.stop()
 
     async def _publish(self, task):
         self._proc_started_ts = time.time()
         self._current_task = task
 
-        self._state = self.State.REFRESHING
+        self._set_state(Publisher.State.REFRESHING)
         await task.profile.refresh()
+        task.commit_id = task.profile.commit_id
+
+        if (
+            self._publisher._skip_up_to_date
+            and not task.force
+            and not task.profile.is_stale
+        ):
+            logger.info(
+                f"CC resource of {task.profile.md.name} is already up to date, "
+                f"skipping the publishing"
+            )
+            task.outcome = PublisherTask.Outcome.UP_TO_DATE
+            task.start_time = task.end_time = time.time()
+            self._set_last_task(task)
+            return
 
-        self._state = self.State.RUNNING
+        self._set_state(Publisher.State.RUNNING)
 
         context = {
             "profile": asdict(task.profile),
-            "auth": self._auth,
+            "auth": self._publisher._auth,
         }
         logger.debug(f"Context: {context}")
-        properties = self._template.render(context)
+        properties = self._publisher._template.render(context)
 
         with tempfile.TemporaryDirectory() as tmpdir:
             properties_file = Path(tmpdir) / "project.properties"
@@ -150,36 +620,110 @@ class Publisher:
             f.write(properties)
             f.close()
 
-            invocation = f"./{self._script.name} properties={properties_file}"
-            logger.info("Running session")
-            logger.info(f" {invocation}")
+            output_file = self._open_output_file(task)
+            try:
+                if self._runner is not None:
+                    returncode = await self._run_warm_session(
+                        task, properties_file, output_file
+                    )
+                else:
+                    returncode = await self._run_session(
+                        task, properties_file, output_file
+                    )
+            finally:
+                if output_file is not None:
+                    output_file.close()
 
-            self._current_task.start_time = time.time()
+            logger.info(f"rc={returncode}")
 
-            # https://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-            self._process = await asyncio.create_subprocess_shell(
-                invocation,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd=self._script.parent,
-                env={"DISPLAY": ":0"},
-                preexec_fn=os.setsid,
+            self._current_task.returncode = returncode
+            self._current_task.outcome = (
+                PublisherTask.Outcome.PUBLISHED
+                if returncode == 0
+                else PublisherTask.Outcome.FAILED
             )
+            self._current_task.end_time = time.time()
 
-            # TODO: add stream reader tasks
-            stdout, stderr = await self._process.communicate()
+            self._set_last_task(self._current_task)
+            self._current_task = None
+            self._process = None
 
-            logger.info(
-                f"rc={self._process.returncode} " f"stdout={stdout} stderr={stderr}"
+            logger.info(f"Session completed on worker #{self._id}")
+
+        # The CC resource has a new revision by now, which the profile has to
+        # show (a full refresh might have replaced it with a new one meanwhile)
+        self._set_state(Publisher.State.REFRESHING)
+        try:
+            await self._publisher._get_known_profile(task.profile).refresh()
+        except Exception as e:
+            logger.error(f"Error while refreshing the profile on worker #{self._id}:")
+            logger.exception(e)
+
+    async def _run_session(self, task, properties_file, output_file):
+        script = self._publisher._script
+        invocation = f"./{script.name} properties={properties_file}"
+        logger.info(f"Running session on worker #{self._id}")
+        logger.info(f" {invocation}")
+
+        task.start_time = time.time()
+
+        # https://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
+        self._process = await asyncio.create_subprocess_shell(
+            invocation,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=script.parent,
+            env={"DISPLAY": ":0"},
+            preexec_fn=os.setsid,
+        )
+
+        task.stats = procstats.ProcessStats()
+        async with procstats.GroupSampler(self._process.pid, task.stats):
+            await asyncio.gather(
+                self._read_stream(
+                    self._process.stdout, "stdout", task.stdout, output_file
+                ),
+                self._read_stream(
+                    self._process.stderr, "stderr", task.stderr, output_file
+                ),
             )
 
-            self._current_task.returncode = self._process.returncode
-            self._current_task.stderr = stderr.decode()
-            self._current_task.stdout = stdout.decode()
-            self._current_task.end_time = time.time()
+            return await self._process.wait()
 
-            self._last_task = self._current_task
-            self._current_task = None
-            self._process = None
+    async def _run_warm_session(self, task, properties_file, output_file):
+        await self._runner.ensure_started()
+        logger.info(f"Running session on the warm runner of worker #{self._id}")
+
+        task.start_time = time.time()
+        # Terminating the task kills the runner, which is restarted afterwards
+        self._process = self._runner.process
+
+        buffers = {"stdout": task.stdout, "stderr": task.stderr}
+        task.stats = procstats.ProcessStats()
+        async with procstats.GroupSampler(self._process.pid, task.stats):
+            return await self._runner.publish(
+                properties_file,
+                lambda name, line: self._add_output_line(
+                    name, buffers[name], line, output_file
+                ),
+            )
+
+    def _open_output_file(self, task):
+        output_dir = self._publisher._output_dir
+        if output_dir is None:
+            return None
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        task.output_file = str(output_dir / f"task-{task.task_id}.log")
+        logger.info(f"Writing task output to {task.output_file}")
+
+        return open(task.output_file, "w")
+
+    async def _read_stream(self, stream, name, buffer, output_file):
+        while (line := await runner.read_line(stream)) is not None:
+            self._add_output_line(name, buffer, line, output_file)
 
-            logger.info("Session completed")
+    def _add_output_line(self, name, buffer, line, output_file):
+        buffer.append(line)
+        if output_file is not None:
+            output_file.write(f"[{name}] {line}\n")
@@ -15,9 +15,35 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
+import logging
+
+from ccpublisher import metrics
+from ccpublisher.notifier import ChangeNotifier
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.Gauge("ccpublisher_queue_depth", "Number of enqueued tasks")
+QUEUE_ENQUEUED = metrics.Counter(
+    "ccpublisher_queue_enqueued_total", "Number of tasks enqueued"
+)
+QUEUE_DEQUEUED = metrics.Counter(
+    "ccpublisher_queue_dequeued_total", "Number of tasks dequeued for processing"
+)
 
 
 class RAQueue:
+    """Queue of items with random access by task ID
+
+    Items are dequeued in insertion order, unless a sort_key function is
+    given: the item with the lowest key is dequeued first then, ties being
+    broken by queue order. When an is_ready predicate is given, items for
+    which it's false are held back until task_done() is called for another
+    item. When an index_key function is given, items are indexed by the key
+    it returns (which mustn't change while they're enqueued) and can be found
+    by it with find().
+    """
+
     class FullError(Exception):
         pass
 
@@ -26,14 +52,28 @@ class RAQueue:
 
     last_id = 0
 
-    def __init__(self, max_size):
+    def __init__(
+        self, max_size, notifier=None, sort_key=None, is_ready=None, index_key=None
+    ):
         self._max_size = max_size
-        self._entries = []
+        self._sort_key = sort_key
+        self._is_ready = is_ready
+        self._index_key = index_key
+        # Task ID -> item, in queue order
+        self._entries = collections.OrderedDict()
+        # Index key -> task ID
+        self._index = {}
         self._available = asyncio.Event()
+        self._notifier = notifier or ChangeNotifier()
 
     @property
     def entries(self):
-        return self._entries
+        entries = list(self._entries.items())
+        if self._sort_key is not None:
+            # Stable: ties keep the queue order
+            entries.sort(key=lambda entry: self._sort_key(entry[1]))
+
+        return entries
 
     @property
     def size(self):
@@ -44,37 +84,310 @@ class RAQueue:
             raise self.FullError()
         else:
             self.last_id += 1
-            self._entries.append((self.last_id, item))
+            self._add_entry(self.last_id, item)
             self._available.set()
+            self._notifier.notify()
+            QUEUE_ENQUEUED.inc()
+            QUEUE_DEPTH.set(len(self._entries))
 
             return self.last_id
 
+    def lookup(self, task_id):
+        try:
+            return self._entries[task_id]
+        except KeyError:
+            raise self.NotFoundError()
+
+    def find(self, key):
+        """Task ID and item indexed by the given key, None if not enqueued"""
+        task_id = self._index.get(key)
+        if task_id is None:
+            return None
+
+        return task_id, self._entries[task_id]
+
+    def update(self, task_id):
+        """Signal that the item has been modified in place"""
+        if task_id not in self._entries:
+            raise self.NotFoundError()
+
+        self._notifier.notify()
+
     def remove(self, task_id):
-        tasks = self._entries[:]
-        for element in tasks:
-            if element[0] == task_id:
-                self._entries.remove(element)
-                return
+        try:
+            self._pop_entry(task_id)
+        except KeyError:
+            raise self.NotFoundError()
+
+        self._notifier.notify()
+        QUEUE_DEPTH.set(len(self._entries))
 
-        raise self.NotFoundError()
+    def move(self, task_id, position):
+        if task_id not in self._entries:
+            raise self.NotFoundError()
+
+        self._entries = self._move_entry(self._entries, task_id, position)
+        self._notifier.notify()
+
+    def move_next_to(self, task_id, anchor_id, after=False):
+        """Move an item right before (or after) another one in queue order"""
+        if task_id not in self._entries or anchor_id not in self._entries:
+            raise self.NotFoundError()
+
+        keys = [key for key in self._entries if key != task_id]
+        self.move(task_id, keys.index(anchor_id) + (1 if after else 0))
 
     def clear(self):
-        self._entries = []
+        self._entries.clear()
+        self._index.clear()
         self._available.clear()
+        self._notifier.notify()
+        QUEUE_DEPTH.set(0)
 
     async def get(self):
         # This works around the possibility of a race condition when
-        # the queue is cleared, preventing an error when popping()
+        # the queue is cleared, preventing an error when popping(), and
+        # waits for a change when none of the entries is ready
         while True:
             await self._available.wait()
-            if not self._entries:
+            entry = self._dequeue()
+            if entry is None:
                 self._available.clear()
             else:
                 break
 
-        task_id, item = self._entries.pop(0)
+        task_id, item = entry
+        self._notifier.notify()
+        QUEUE_DEQUEUED.inc()
+        QUEUE_DEPTH.set(len(self._entries))
 
         if not self._entries:
             self._available.clear()
 
         return item
+
+    def task_done(self, task_id):
+        # Entries held back by is_ready() might have become ready
+        if self._entries:
+            self._available.set()
+
+    def _dequeue(self):
+        if self._sort_key is None and self._is_ready is None:
+            if not self._entries:
+                return None
+
+            task_id = next(iter(self._entries))
+            return task_id, self._pop_entry(task_id)
+
+        entries = self._entries.items()
+        if self._is_ready is not None:
+            entries = [entry for entry in entries if self._is_ready(entry[1])]
+        if not entries:
+            return None
+
+        if self._sort_key is None:
+            task_id, _ = next(iter(entries))
+        else:
+            # min() returns the first of the lowest keys, preserving queue order
+            task_id, _ = min(entries, key=lambda entry: self._sort_key(entry[1]))
+
+        return task_id, self._pop_entry(task_id)
+
+    def _add_entry(self, task_id, item):
+        self._entries[task_id] = item
+        if self._index_key is not None:
+            self._index[self._index_key(item)] = task_id
+
+    def _pop_entry(self, task_id):
+        item = self._entries.pop(task_id)
+        if self._index_key is not None:
+            key = self._index_key(item)
+            if self._index.get(key) == task_id:
+                del self._index[key]
+
+        return item
+
+    @staticmethod
+    def _move_entry(entries, key, position):
+        # Moving to either end is O(1), anywhere else requires a rebuild
+        if position <= 0:
+            entries.move_to_end(key, last=False)
+        elif position >= len(entries) - 1:
+            entries.move_to_end(key)
+        else:
+            item = entries.pop(key)
+            reordered = list(entries.items())
+            reordered.insert(position, (key, item))
+            entries = collections.OrderedDict(reordered)
+
+        return entries
+
+
+class PersistentRAQueue(RAQueue):
+    """RAQueue whose entries are journaled and survive restarts
+
+    Items are stored as returned by encode() and restored with
+    decode(task_id, data), which returns None when an entry can't be
+    restored yet: such entries are kept in the journal, and enqueued once
+    retry_restore() manages to decode them (or dropped by remove() and
+    clear()). Entries that were dequeued but never marked with task_done()
+    (because the service stopped while processing them) are enqueued again,
+    ahead of the others in queue order: when a sort_key is given they're
+    ranked like any other entry, the queue order only breaking ties. The
+    journal is compacted down to the current state at startup and whenever
+    it grows past its threshold.
+    """
+
+    def __init__(
+        self,
+        max_size,
+        journal,
+        encode,
+        decode,
+        notifier=None,
+        sort_key=None,
+        is_ready=None,
+        index_key=None,
+    ):
+        super().__init__(max_size, notifier, sort_key, is_ready, index_key)
+        self._journal = journal
+        self._encode = encode
+        self._decode = decode
+        # Task ID -> encoded item that couldn't be decoded yet
+        self._unrestored = collections.OrderedDict()
+        # Task ID -> item dequeued and not yet done
+        self._started = {}
+        self._replay()
+
+    @property
+    def unrestored_count(self):
+        return len(self._unrestored)
+
+    def retry_restore(self):
+        """Enqueue the entries that can be decoded by now, return their number"""
+        restored = 0
+        for task_id, data in list(self._unrestored.items()):
+            item = self._decode(task_id, data)
+            if item is None:
+                continue
+
+            # Their put records are still in the journal, nothing to append
+            del self._unrestored[task_id]
+            self._add_entry(task_id, item)
+            restored += 1
+
+        if restored:
+            logger.info(f"Restored {restored} tasks that couldn't be restored before")
+            self._available.set()
+            self._notifier.notify()
+            QUEUE_DEPTH.set(len(self._entries))
+
+        return restored
+
+    def put(self, item):
+        task_id = super().put(item)
+        self._append({"op": "put", "id": task_id, "item": self._encode(item)})
+
+        return task_id
+
+    def remove(self, task_id):
+        if self._unrestored.pop(task_id, None) is None:
+            super().remove(task_id)
+        self._append({"op": "remove", "id": task_id})
+
+    def update(self, task_id):
+        super().update(task_id)
+        self._append(
+            {
+                "op": "update",
+                "id": task_id,
+                "item": self._encode(self._entries[task_id]),
+            }
+        )
+
+    def move(self, task_id, position):
+        super().move(task_id, position)
+        self._append({"op": "move", "id": task_id, "position": position})
+
+    def clear(self):
+        super().clear()
+        self._unrestored.clear()
+        self._append({"op": "clear"})
+
+    def task_done(self, task_id):
+        super().task_done(task_id)
+        self._started.pop(task_id, None)
+        self._append({"op": "done", "id": task_id})
+
+    def _dequeue(self):
+        entry = super()._dequeue()
+        if entry is not None:
+            self._started[entry[0]] = entry[1]
+            self._append({"op": "start", "id": entry[0]})
+
+        return entry
+
+    def _append(self, record):
+        self._journal.append(record)
+        if self._journal.needs_compaction:
+            self._compact()
+
+    def _compact(self):
+        # Rewrites the journal down to the records replaying the current state
+        records = [{"op": "last_id", "id": self.last_id}]
+        for task_id, item in self._started.items():
+            records.append({"op": "put", "id": task_id, "item": self._encode(item)})
+            records.append({"op": "start", "id": task_id})
+        for task_id, item in self._entries.items():
+            records.append({"op": "put", "id": task_id, "item": self._encode(item)})
+        for task_id, data in self._unrestored.items():
+            records.append({"op": "put", "id": task_id, "item": data})
+
+        self._journal.rewrite(records)
+
+    def _replay(self):
+        enqueued = collections.OrderedDict()
+        started = collections.OrderedDict()
+        for record in self._journal.load():
+            op = record["op"]
+            if op == "put":
+                enqueued[record["id"]] = record["item"]
+                self.last_id = max(self.last_id, record["id"])
+            elif op == "update":
+                if record["id"] in enqueued:
+                    enqueued[record["id"]] = record["item"]
+            elif op == "remove":
+                enqueued.pop(record["id"], None)
+            elif op == "move":
+                if record["id"] in enqueued:
+                    enqueued = self._move_entry(
+                        enqueued, record["id"], record["position"]
+                    )
+            elif op == "clear":
+                enqueued.clear()
+            elif op == "start":
+                if record["id"] in enqueued:
+                    started[record["id"]] = enqueued.pop(record["id"])
+            elif op == "done":
+                started.pop(record["id"], None)
+            elif op == "last_id":
+                self.last_id = max(self.last_id, record["id"])
+
+        for task_id, data in {**started, **enqueued}.items():
+            item = self._decode(task_id, data)
+            if item is None:
+                logger.warning(f"Task {task_id} can't be restored yet, keeping it")
+                self._unrestored[task_id] = data
+                continue
+
+            self._add_entry(task_id, item)
+
+        if self._entries:
+            logger.info(
+                f"Restored {len(self._entries)} tasks "
+                f"({len(started)} interrupted while running)"
+            )
+            self._available.set()
+        QUEUE_DEPTH.set(len(self._entries))
+
+        self._compact()
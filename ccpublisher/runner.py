@@ -0,0 +1,226 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+import signal
+from pathlib import Path
+
+from ccpublisher import procstats
+
+logger = logging.getLogger(__name__)
+
+
+async def read_line(stream):
+    """Read a line of output, returning None at the end of the stream"""
+    try:
+        line = await stream.readline()
+    except ValueError:
+        # The line exceeded the stream limit and has been discarded
+        return "<line too long, skipped>"
+
+    if not line:
+        return None
+
+    return line.decode(errors="replace").rstrip()
+
+
+class WarmRunner:
+    """Long-lived publishing process that runs successive sessions
+
+    The runner script is started once, in its own process group, and is
+    driven through a line protocol on its stdin:
+
+    - PUBLISH <properties file>: runs a publishing session, which is
+      acknowledged with "@@CCPUB DONE <returncode>" on stdout
+    - PING: answered with "@@CCPUB PONG"
+    - QUIT: terminates the runner
+
+    The runner announces with "@@CCPUB READY" that it has warmed up. Any
+    other output line belongs to the session being run. The runner is
+    health checked before every session and restarted after max_tasks
+    sessions or when its memory usage exceeds max_rss MiB.
+    """
+
+    MARKER = "@@CCPUB"
+    QUIT_TIMEOUT = 30
+
+    class Error(Exception):
+        pass
+
+    def __init__(
+        self,
+        script,
+        name="runner",
+        max_tasks=20,
+        max_rss=None,
+        startup_timeout=600,
+        ping_timeout=30,
+    ):
+        self._script = Path(script)
+        self._name = name
+        self._max_tasks = max_tasks
+        self._max_rss = max_rss
+        self._startup_timeout = startup_timeout
+        self._ping_timeout = ping_timeout
+        self._process = None
+        self._stderr_reader = None
+        self._tasks_count = 0
+        self._output = None
+
+    @property
+    def process(self):
+        return self._process
+
+    @property
+    def is_running(self):
+        return self._process is not None and self._process.returncode is None
+
+    async def ensure_started(self):
+        """Start the runner, restarting it when unhealthy or due for recycling"""
+        if self.is_running:
+            reason = self._get_recycle_reason()
+            if reason is None and await self.ping():
+                return
+
+            if reason is not None:
+                logger.info(f"Recycling {self._name}: {reason}")
+            else:
+                logger.warning(f"{self._name} failed the health check, restarting")
+
+        await self.stop()
+        await self._start()
+
+    async def publish(self, properties_file, output):
+        """Run a session, passing each output line to output(name, line)
+
+        Returns the return code of the session, or the one of the runner
+        when it exits in the middle of it.
+        """
+        self._output = output
+        try:
+            await self._send(f"PUBLISH {properties_file}")
+            args = await self._read_reply("DONE")
+        except self.Error as e:
+            logger.warning(f"{self._name} failed while publishing: {e}")
+            return await self._process.wait()
+        finally:
+            self._output = None
+
+        self._tasks_count += 1
+
+        return int(args[0])
+
+    async def ping(self):
+        try:
+            await self._send("PING")
+            await asyncio.wait_for(self._read_reply("PONG"), self._ping_timeout)
+        except (asyncio.TimeoutError, self.Error):
+            return False
+
+        return True
+
+    async def stop(self):
+        if self._process is None:
+            return
+
+        if self._process.returncode is None:
+            logger.info(f"Stopping {self._name}")
+            try:
+                await self._send("QUIT")
+                await asyncio.wait_for(self._process.wait(), self.QUIT_TIMEOUT)
+            except (asyncio.TimeoutError, self.Error):
+                logger.warning(f"{self._name} didn't quit, killing it")
+                try:
+                    os.killpg(self._process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await self._process.wait()
+
+        await self._stderr_reader
+        self._process = None
+        self._stderr_reader = None
+
+    async def _start(self):
+        logger.info(f"Starting {self._name}: ./{self._script.name}")
+        self._process = await asyncio.create_subprocess_exec(
+            f"./{self._script.name}",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=self._script.parent,
+            env={"DISPLAY": ":0"},
+            preexec_fn=os.setsid,
+        )
+        self._stderr_reader = asyncio.create_task(self._read_stderr())
+        self._tasks_count = 0
+
+        try:
+            await asyncio.wait_for(self._read_reply("READY"), self._startup_timeout)
+        except (asyncio.TimeoutError, self.Error) as e:
+            await self.stop()
+            raise self.Error(f"{self._name} didn't become ready") from e
+
+        logger.info(f"{self._name} is ready")
+
+    def _get_recycle_reason(self):
+        if self._tasks_count >= self._max_tasks:
+            return f"{self._tasks_count} sessions run"
+
+        if self._max_rss is not None:
+            samples = procstats.read_group(self._process.pid).values()
+            rss = sum(sample.rss for sample in samples) // 2**20
+            if rss > self._max_rss:
+                return f"using {rss} MiB of memory"
+
+        return None
+
+    async def _send(self, command):
+        if not self.is_running:
+            raise self.Error("Runner is not running")
+
+        try:
+            self._process.stdin.write(f"{command}\n".encode())
+            await self._process.stdin.drain()
+        except ConnectionError as e:
+            raise self.Error(f"Runner closed its input: {e}")
+
+    async def _read_reply(self, keyword):
+        while True:
+            line = await read_line(self._process.stdout)
+            if line is None:
+                raise self.Error(f"Runner exited with rc={await self._process.wait()}")
+
+            if not line.startswith(self.MARKER):
+                self._emit("stdout", line)
+                continue
+
+            reply = line[len(self.MARKER) :].split()
+            if reply and reply[0] == keyword:
+                return reply[1:]
+
+            logger.warning(f"Unexpected reply from {self._name}: {line}")
+
+    async def _read_stderr(self):
+        while (line := await read_line(self._process.stderr)) is not None:
+            self._emit("stderr", line)
+
+    def _emit(self, name, line):
+        if self._output is not None:
+            self._output(name, line)
+        else:
+            logger.debug(f"{self._name} [{name}] {line}")
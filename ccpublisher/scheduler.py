@@ -0,0 +1,124 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import logging
+import time
+
+from ccpublisher import queue
+
+logger = logging.getLogger(__name__)
+
+
+class StaleScheduler:
+    """Enqueues publishing tasks for profiles that became stale
+
+    Every interval seconds the known profiles are refreshed (only the
+    resources that changed are fetched again from TWC) and a task is
+    enqueued for each profile that turned stale because of a new MD commit.
+    A profile is published only once its last commit is older than
+    quiet_period seconds, so that bursts of commits are debounced, and at
+    most max_enqueues tasks are enqueued every rate_window seconds.
+    Profiles that are stale at startup are left alone until their next
+    commit.
+    """
+
+    def __init__(
+        self,
+        profiles_manager,
+        publisher,
+        interval=300,
+        quiet_period=600,
+        max_enqueues=5,
+        rate_window=3600,
+    ):
+        self._profiles_manager = profiles_manager
+        self._publisher = publisher
+        self._interval = interval
+        self._quiet_period = quiet_period
+        self._max_enqueues = max_enqueues
+        self._rate_window = rate_window
+        # Profile ID -> MD commit ID already handled (baseline or enqueued)
+        self._handled_commits = None
+        self._enqueue_times = collections.deque()
+
+    def start(self):
+        return asyncio.create_task(self._scheduler_task(), name="Scheduler task")
+
+    async def _scheduler_task(self):
+        logger.info(
+            f"Scheduler started, scanning every {self._interval}s "
+            f"with a quiet period of {self._quiet_period}s"
+        )
+
+        while True:
+            try:
+                await self._profiles_manager.refresh_known_profiles()
+                self._schedule()
+            except Exception as e:
+                logger.error("Error while scanning for stale profiles:")
+                logger.exception(e)
+
+            await asyncio.sleep(self._interval)
+
+    def _schedule(self):
+        profiles = self._profiles_manager.profiles
+
+        if self._handled_commits is None:
+            self._handled_commits = {
+                profile.id: profile.commit_id for profile in profiles
+            }
+            return
+
+        now = time.time()
+        for profile in profiles:
+            commit_id = profile.commit_id
+            if (
+                not profile.is_stale
+                or self._handled_commits.get(profile.id) == commit_id
+            ):
+                continue
+
+            if now - profile.md.modified.timestamp() < self._quiet_period:
+                logger.debug(f"Profile {profile.md.name} in quiet period")
+                continue
+
+            if not self._acquire_rate_slot(now):
+                logger.warning("Enqueuing rate limit reached, postponing")
+                break
+
+            try:
+                task_id, _ = self._publisher.publish(profile)
+            except queue.RAQueue.FullError:
+                logger.warning("Queue is full, postponing")
+                break
+
+            logger.info(
+                f"Profile {profile.md.name} is stale at commit {commit_id}, "
+                f"enqueued as task {task_id}"
+            )
+            self._handled_commits[profile.id] = commit_id
+
+    def _acquire_rate_slot(self, now):
+        while self._enqueue_times and now - self._enqueue_times[0] > self._rate_window:
+            self._enqueue_times.popleft()
+
+        if len(self._enqueue_times) >= self._max_enqueues:
+            return False
+
+        self._enqueue_times.append(now)
+        return True
@@ -21,7 +21,15 @@ import functools
 
 import yaml
 
-from ccpublisher import api, publisher, fileobserver, profile, __version__
+from ccpublisher import (
+    api,
+    publisher,
+    fileobserver,
+    profile,
+    notifier,
+    scheduler,
+    __version__,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -39,24 +47,62 @@ class Service:
                 getattr(signal, signame), functools.partial(self._shutdown, signame)
             )
 
+        notifier_ = notifier.ChangeNotifier()
+
         profiles_manager = profile.ProfilesManager(
             api_url=self._config["twc"]["api_url"],
             login=self._config["auth"]["username"],
             password=self._config["auth"]["password"],
+            max_concurrency=self._config["twc"].get("max_concurrency", 4),
+            connection_limit=self._config["twc"].get("connection_limit", 8),
+            notifier=notifier_,
         )
         await profiles_manager.fetch_all_profiles()
 
+        runner_config = self._config["publisher"].get("runner", None)
+        runner_options = runner_config and {
+            "script": runner_config["script"],
+            "max_tasks": runner_config.get("max_tasks", 20),
+            "max_rss": runner_config.get("max_rss", None),
+            "startup_timeout": runner_config.get("startup_timeout", 600),
+            "ping_timeout": runner_config.get("ping_timeout", 30),
+        }
+
         publisher_ = publisher.Publisher(
             template=self._config["publisher"]["template"],
             auth=self._config["auth"],
             script=self._config["publisher"]["script"],
             max_tasks=self._config["publisher"]["queue_maxsize"],
+            workers=self._config["publisher"].get("workers", 1),
+            output_backlog=self._config["publisher"].get("output_backlog", 100),
+            output_dir=self._config["publisher"].get("output_dir", None),
+            state_dir=self._config["publisher"].get("state_dir", None),
+            get_profile=profiles_manager.get_profile,
+            history_size=self._config["publisher"].get("history_size", 100),
+            aging_interval=self._config["publisher"].get("aging_interval", 3600),
+            skip_up_to_date=self._config["publisher"].get("skip_up_to_date", False),
+            runner=runner_options,
+            notifier=notifier_,
         )
         publisher_.start()
 
+        scheduler_config = self._config.get("scheduler", {})
+        if scheduler_config.get("enabled", False):
+            scheduler_ = scheduler.StaleScheduler(
+                profiles_manager=profiles_manager,
+                publisher=publisher_,
+                interval=scheduler_config.get("interval", 300),
+                quiet_period=scheduler_config.get("quiet_period", 600),
+                max_enqueues=scheduler_config.get("max_enqueues", 5),
+                rate_window=scheduler_config.get("rate_window", 3600),
+            )
+            scheduler_.start()
+
         fileobserver_ = fileobserver.FileObserver(
             file_path=self._config["fileobserver"]["file_path"],
             backlog=self._config["fileobserver"]["backlog"],
+            max_files=self._config["fileobserver"].get("max_files", 20),
+            notifier=notifier_,
         )
         fileobserver_.start()
 
@@ -64,14 +110,19 @@ class Service:
             publisher=publisher_,
             fileobserver=fileobserver_,
             profiles_manager=profiles_manager,
+            notifier=notifier_,
             extra_context=self._config["extra_context"],
             listen_address=self._config["api"]["listen_address"],
             port=self._config["api"]["port"],
+            profiles_ttl=self._config["api"].get("profiles_ttl", 60),
         )
         await api_.start()
 
-        while True:
-            await asyncio.sleep(1)
+        try:
+            while True:
+                await asyncio.sleep(1)
+        finally:
+            await profiles_manager.close()
 
     def _shutdown(self, signame):
         logger.info(
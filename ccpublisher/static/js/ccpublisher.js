@@ -15,13 +15,14 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-var previous_state = null;
+var current_status = null;
+var status_received_at = 0;
 
-function update_publish_buttons(running_profile_id, enqueued_resource_ids) {
+function update_publish_buttons(running_profile_ids, enqueued_resource_ids) {
     $('#profiles button.publish').each(
         function() {
             let profile_id = $(this).attr('id').replace('button-', '');
-            if (running_profile_id && running_profile_id === profile_id) {
+            if (running_profile_ids.has(profile_id)) {
                 $(this).find('.spinner').show();
                 $(this).find('.button-text').text('Publishing..');
                 $(this).prop('disabled', true);
@@ -38,75 +39,150 @@ function update_publish_buttons(running_profile_id, enqueued_resource_ids) {
     )
 }
 
-function get_status() {
-    $.getJSON('/api/v1/status')
-        .done(function(data) {
-            let enqueued_resource_ids = new Set();
-            let queue_table_contents = '';
-
-            // TODO: it might miss some transitions
-            if (previous_state === 'RUNNING' && data.publisher.state === 'IDLE') {
-                previous_state = null;
-                $('#profiles').hide();
-                $('#refresh').show();
-                location.reload();
-            } else {
-                previous_state = data.publisher.state;
-            }
+function task_elapsed(task, server_time) {
+    if (task.end_time !== 0) {
+        return Math.floor(task.elapsed);
+    } else if (task.start_time === 0) {
+        return 0;
+    }
+    // Both times are taken from the server clock, the local one only
+    // accounts for the time passed since the status was received
+    let now = server_time + (Date.now() - status_received_at) / 1000;
+    return Math.max(Math.floor(now - task.start_time), 0);
+}
 
-            for (let idx in data.publisher.queue) {
-                entry = data.publisher.queue[idx];
-                enqueued_resource_ids.add(entry.task.profile.id);
-                queue_table_contents += `<tr><td>${parseInt(idx)+1}</td><td>${entry.task.profile.md.category_path}/${entry.task.profile.md.name}</td></tr>`;
-            }
-            update_publish_buttons(
-                data.publisher.current_task && data.publisher.current_task.profile.id,
-                enqueued_resource_ids
-            );
-            $('#queue_tbody').html(queue_table_contents);
-
-            if (data.publisher.state === 'RUNNING' || data.publisher.state === 'REFRESHING') {
-                $('#spinner').show();
-                $('#terminate').prop('disabled', false);
-            } else {
-                $('#spinner').hide();
-                $('#terminate').prop('disabled', true);
-            }
+function render_running_tasks(running_tasks, server_time) {
+    // Rows are rebuilt only when the running tasks change, so that the
+    // terminate buttons aren't replaced under the pointer while ticking
+    let key = running_tasks.map(entry => `${entry.worker_id}:${entry.task.task_id}`).join(',');
+    if ($('#current_project').data('key') !== key) {
+        let contents = '';
+        for (let entry of running_tasks) {
+            let task = entry.task;
+            contents += `<div>${task.profile.md.category_path}/${task.profile.md.name} ` +
+                `(running since <span id="elapsed-${entry.worker_id}"></span>s) ` +
+                `<button class="btn btn-outline-dark btn-sm py-0" onclick="terminate_session(${entry.worker_id})">Terminate</button></div>`;
+        }
+        $('#current_project').html(running_tasks.length > 0 ? contents : 'No task running');
+        $('#current_project').data('key', key);
+    }
 
-            $('#state').html(data.publisher.state);
-            $('#qsize').html(data.publisher.queue.length);
-            if (data.publisher.current_task && data.publisher.current_task.profile) {
-                $('#current_project').html(
-                    `${data.publisher.current_task.profile.md.category_path}/${data.publisher.current_task.profile.md.name} (running since ${Math.floor(data.publisher.current_task.elapsed)}s)`
-                );
-            } else {
-                $('#current_project').html('No task running');
-            }
+    for (let entry of running_tasks) {
+        $(`#elapsed-${entry.worker_id}`).text(task_elapsed(entry.task, server_time));
+    }
+}
 
-            if (data.publisher.last_task) {
-                $('#last_task').html(
-                    `${data.publisher.last_task.profile.md.category_path}/${data.publisher.last_task.profile.md.name} (rc=${data.publisher.last_task.returncode})`
-                );
-            } else {
-                $('#last_task').html('N/A');
-            }
+function render_status(data) {
+    let enqueued_resource_ids = new Set();
+    let running_profile_ids = new Set();
+    let running_tasks = [];
+    let queue_table_contents = '';
 
-            if (data.publisher.queue.length > 0) {
-                $('#killtasks').prop('disabled', false);
-            } else {
-                $('#killtasks').prop('disabled', true);
-            }
+    // The profiles are rendered by the page, which is reloaded once they change
+    if (data.profiles_version !== $('#profiles').data('version')) {
+        $('#profiles').hide();
+        $('#refresh').show();
+        location.reload();
+    }
+
+    for (let idx in data.publisher.queue) {
+        entry = data.publisher.queue[idx];
+        enqueued_resource_ids.add(entry.task.profile.id);
+        queue_table_contents += `<tr><td>${parseInt(idx)+1}</td><td>${entry.task.profile.md.category_path}/${entry.task.profile.md.name}</td></tr>`;
+    }
+    for (let worker of data.publisher.workers) {
+        let task = worker.current_task;
+        if (task && task.profile) {
+            running_profile_ids.add(task.profile.id);
+            running_tasks.push({worker_id: worker.worker_id, task: task});
+        }
+    }
+    update_publish_buttons(running_profile_ids, enqueued_resource_ids);
+    $('#queue_tbody').html(queue_table_contents);
+
+    if (data.publisher.state === 'RUNNING' || data.publisher.state === 'REFRESHING') {
+        $('#spinner').show();
+    } else {
+        $('#spinner').hide();
+    }
+
+    $('#state').html(data.publisher.state);
+    $('#qsize').html(data.publisher.queue.length);
+    render_running_tasks(running_tasks, data.time);
+
+    if (data.publisher.last_task) {
+        $('#last_task').html(
+            `${data.publisher.last_task.profile.md.category_path}/${data.publisher.last_task.profile.md.name} (${data.publisher.last_task.outcome}, rc=${data.publisher.last_task.returncode})`
+        );
+    } else {
+        $('#last_task').html('N/A');
+    }
+
+    if (data.publisher.queue.length > 0) {
+        $('#killtasks').prop('disabled', false);
+    } else {
+        $('#killtasks').prop('disabled', true);
+    }
+}
+
+function apply_status_diff(diff) {
+    if (current_status === null) {
+        current_status = {};
+    }
+
+    for (let section in diff) {
+        let value = diff[section];
+        if (value !== null && typeof value === 'object' && !Array.isArray(value)
+                && current_status[section]) {
+            Object.assign(current_status[section], value);
+        } else {
+            current_status[section] = value;
+        }
+    }
+}
 
-            let loglines_content = data.loglines.join('\n');
-            if ($('#loglines').html() != loglines_content) {
-                $('#loglines').html(loglines_content);
-                $('#loglines').prop('scrollTop', $('#loglines').prop('scrollHeight'));
+function connect_events() {
+    let source = new EventSource('/api/v1/events');
+
+    source.addEventListener('status', function(event) {
+        apply_status_diff(JSON.parse(event.data));
+        status_received_at = Date.now();
+        render_status(current_status);
+        $('#connection-error').hide();
+    });
+
+    source.onerror = function() {
+        // The browser reconnects by itself, the first event carries the whole status
+        current_status = null;
+        $('#connection-error').show();
+    };
+
+    // Keep the elapsed times ticking between pushes
+    setInterval(
+        function() {
+            if (current_status !== null) {
+                render_status(current_status);
             }
-            $('#connection-error').hide();
-        })
-        .fail(function() {
-            $('#connection-error').show();
-        });
+        },
+        1000
+    );
+}
+
+function connect_loglines() {
+    // Each event carries only the lines following the last one received, the
+    // browser resumes from it (Last-Event-ID) when reconnecting
+    let source = new EventSource('/api/v1/loglines/events');
+    let backlog = parseInt($('#loglines').data('backlog'));
+    let loglines = [];
+
+    source.addEventListener('lines', function(event) {
+        let data = JSON.parse(event.data);
+        // Lines were missed: the event carries the whole backlog then
+        loglines = data.truncated ? data.lines : loglines.concat(data.lines);
+        loglines = loglines.slice(-backlog);
+        $('#loglines').text(loglines.join('\n'));
+        $('#loglines').prop('scrollTop', $('#loglines').prop('scrollHeight'));
+    });
 }
 
 function publish(profile_id) {
@@ -114,8 +190,13 @@ function publish(profile_id) {
         {
             url: '/api/v1/tasks',
             method: 'POST',
-            data: {profile_id: profile_id},
+            // Explicit requests from the UI always publish, even if up to date
+            data: {profile_id: profile_id, force: true},
             statusCode: {
+                200: function() {
+                    $('#toast-msg').html('Task already enqueued or being published');
+                    $('.toast').toast('show');
+                },
                 201: function() {
                     $('#toast-msg').html('Task successfully enqueued');
                     $('.toast').toast('show');
@@ -135,16 +216,14 @@ function publish(profile_id) {
             $('#toast-msg').html('Error while attempting to enqueue publish job');
             $('.toast').toast('show');
         });
-
-    // Force immediate status refresh
-    get_status();
 }
 
-function terminate_session()
+function terminate_session(worker_id)
 {
+    // Only the given worker is stopped, the others keep publishing
     $.ajax(
         {
-            url: '/api/v1/current_task',
+            url: `/api/v1/current_task?worker_id=${worker_id}`,
             method: 'DELETE',
             statusCode: {
                 204: function() {
@@ -161,9 +240,6 @@ function terminate_session()
             $('#toast-msg').html('Error while attempting to terminate current session')
             $('.toast').toast('show');
         });
-
-    // Force immediate status refresh
-    get_status();
 }
 
 function kill_tasks()
@@ -187,9 +263,6 @@ function kill_tasks()
             $('#toast-msg').html('Error while attempting to terminate current session')
             $('.toast').toast('show');
         });
-
-    // Force immediate status refresh
-    get_status();
 }
 
 function rescan_profiles()
@@ -0,0 +1,131 @@
+# ccpublisher - Cameo Collaborator's publishing service
+# Copyright (C) 2022  Archimedes Exhibitions GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import re
+from contextlib import asynccontextmanager
+
+import aiohttp
+import atwc
+
+from ccpublisher import metrics
+
+logger = logging.getLogger(__name__)
+
+TWC_REQUEST_DURATION = metrics.Histogram(
+    "ccpublisher_twc_request_duration_seconds",
+    "Duration of the requests to TWC, by operation",
+    labels=("operation",),
+)
+
+
+class Client(atwc.client.Client):
+    """atwc client keeping a long-lived, pooled session
+
+    The session is opened and logged in when first needed, then shared by
+    every create_session() context, so that connections are kept alive
+    across refreshes. Requests rejected because the login expired are
+    retried after logging in again, those failing because a pooled
+    connection was dropped are retried once. The duration of each request
+    is recorded.
+    """
+
+    # Path segments that are identifiers (UUIDs, revisions)
+    ID_SEGMENT = re.compile(r"^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]+)$")
+
+    def __init__(
+        self, api_url, login, password, connection_limit=8, keepalive_timeout=30
+    ):
+        super().__init__(api_url=api_url, login=login, password=password)
+        self._connection_limit = connection_limit
+        self._keepalive_timeout = keepalive_timeout
+        self._login_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def create_session(self):
+        async with self._login_lock:
+            if self._session is None or self._session.closed:
+                await self._open_session()
+
+        yield self._session
+
+    async def close(self):
+        if self._session is None:
+            return
+
+        try:
+            await self._logout()
+        except Exception as e:
+            logger.warning(f"Cannot log out from TWC: {e}")
+        finally:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, path):
+        with TWC_REQUEST_DURATION.time(operation=self._get_operation("GET", path)):
+            return await self._request(super().get, path)
+
+    async def post(self, path, data):
+        with TWC_REQUEST_DURATION.time(operation=self._get_operation("POST", path)):
+            return await self._request(super().post, path, data)
+
+    async def _open_session(self):
+        self._session = aiohttp.ClientSession(
+            auth=self._auth,
+            raise_for_status=True,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            connector=aiohttp.TCPConnector(
+                limit=self._connection_limit,
+                keepalive_timeout=self._keepalive_timeout,
+            ),
+        )
+        try:
+            await self._login()
+        except Exception:
+            await self._session.close()
+            self._session = None
+            raise
+
+        logger.info("TWC session opened")
+
+    async def _request(self, request, path, *args):
+        try:
+            return await request(path, *args)
+        except aiohttp.ClientResponseError as e:
+            if e.status != 401 or path in ("login", "logout"):
+                raise
+
+            logger.info("TWC login expired, logging in again")
+            async with self._login_lock:
+                await self._login()
+        except aiohttp.ServerDisconnectedError:
+            logger.debug("TWC connection dropped, retrying")
+
+        return await request(path, *args)
+
+    def _get_operation(self, method, path):
+        # Identifiers are masked, keeping the number of operations bounded
+        segments = path.split("?", 1)[0].strip("/").split("/")
+        return " ".join(
+            [
+                method,
+                "/".join(
+                    "{id}" if self.ID_SEGMENT.match(segment) else segment
+                    for segment in segments
+                ),
+            ]
+        )
@@ -0,0 +1,34 @@
+#!/bin/bash
+
+# Mock of a warm publishing runner, see the "runner" section of the publisher
+# configuration for the protocol
+
+echo "Warming up for 3 seconds"
+sleep 3
+echo "@@CCPUB READY"
+
+while read -r command args
+do
+    case "$command" in
+        PUBLISH)
+            echo "Sleeping 10 seconds, pretending we're publishing $args"
+            for i in $(seq 10)
+            do
+                echo "Step $i/10 (stdout)"
+                echo "Step $i/10 (log)" >>/tmp/test.log
+                sleep 1
+            done
+            echo "Done"
+            echo "@@CCPUB DONE 0"
+            ;;
+        PING)
+            echo "@@CCPUB PONG"
+            ;;
+        QUIT)
+            exit 0
+            ;;
+        *)
+            echo "Unknown command: $command" >&2
+            ;;
+    esac
+done